@@ -1,13 +1,27 @@
+import asyncio
+import gzip
+import hashlib
 import json
 import os
 import datetime
+import time
+import typing
+import bson
 import discord
+from bson import ObjectId, json_util
 from discord.ext import commands
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteOne, IndexModel, ReplaceOne
+from pymongo.errors import PyMongoError
 
 from core import checks
 from core.models import PermissionLevel
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 class BackupDB(commands.Cog):
     """
@@ -20,56 +34,465 @@ class BackupDB(commands.Cog):
         self.bot = bot
         self.db = bot.plugin_db.get_partition(self)
         self.running = False
+        self.batch_size = 1000
+        # number of collections / shards copied at the same time
+        self.workers = 4
+        # collections with more documents than this are split into _id ranges
+        self.shard_size = 100000
+        # local archives, one directory per archive with a manifest.json
+        self.archive_path = "./backups"
+        # documents per compressed archive file
+        self.chunk_size = 10000
+        # restores are written here first and then renamed over the live collections
+        self.staging_prefix = "restore_staging."
+        self.bot.loop.create_task(self._set_batch_size())
+
+    async def _set_batch_size(self):
+        config = await self.db.find_one({"_id": "config"})
+        if config is not None:
+            self.batch_size = config.get("batchSize", self.batch_size)
+
+    async def _copy_collection(
+        self, source, target, name: str, query: dict = None, prefix: str = ""
+    ):
+        """
+        Stream a collection in batches, only one batch is held in memory at a time.
+
+        Returns the number of copied documents and the seconds it took.
+        """
+        start = time.perf_counter()
+        copied = 0
+        batch = []
+        async for document in source[name].find(query or {}).batch_size(self.batch_size):
+            batch.append(document)
+            if len(batch) >= self.batch_size:
+                await target[prefix + name].insert_many(batch, ordered=False)
+                copied += len(batch)
+                batch = []
+        if batch:
+            await target[prefix + name].insert_many(batch, ordered=False)
+            copied += len(batch)
+        return copied, time.perf_counter() - start
+
+    async def _shards(self, collection) -> list:
+        """
+        Split a large collection into _id ranges that can be copied independently.
+        """
+        count = await collection.estimated_document_count()
+        if count <= self.shard_size:
+            return [None]
+
+        # the server splits the _id index into equal ranges, only the range bounds are sent back
+        buckets = collection.aggregate(
+            [{"$bucketAuto": {"groupBy": "$_id", "buckets": -(-count // self.shard_size)}}],
+            allowDiskUse=True,
+        )
+        bounds = [bucket["_id"]["min"] async for bucket in buckets][1:]
+        if not bounds:
+            return [None]
+
+        # range queries only match ids of the same type (logs use string ids, most others ObjectIds)
+        types = {self._bson_type(bound) for bound in bounds}
+        if len(types) != 1 or None in types:
+            return [None]
+        bson_type = types.pop()
+
+        shards = [{"_id": {"$lt": bounds[0]}}]
+        for low, high in zip(bounds, bounds[1:]):
+            shards.append({"_id": {"$gte": low, "$lt": high}})
+        shards.append({"_id": {"$gte": bounds[-1]}})
+        shards.append({"_id": {"$not": {"$type": bson_type}}})
+        return shards
+
+    @staticmethod
+    def _bson_type(value) -> typing.Optional[str]:
+        """
+        The $type alias whose values range queries compare with each other, None if not supported.
+        """
+        if isinstance(value, ObjectId):
+            return "objectId"
+        if isinstance(value, str):
+            return "string"
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return "number"
+        return None
+
+    @staticmethod
+    async def _resume_token(collection):
+        """
+        Get a change stream resume token for the current point in time.
+
+        Returns None if the server doesn't support change streams (standalone servers).
+        """
+        try:
+            async with collection.watch() as stream:
+                await stream.try_next()
+                return stream.resume_token
+        except PyMongoError:
+            return None
+
+    async def _apply_changes(self, source, target, name: str, token):
+        """
+        Replay the changes made to a collection since `token` onto the backup.
+
+        Returns the number of applied changes and the new resume token, or None if the
+        collection has to be copied in full again (token expired, collection dropped or renamed).
+        """
+        applied = 0
+        requests = []
+        try:
+            async with source[name].watch(
+                full_document="updateLookup", resume_after=token
+            ) as stream:
+                while True:
+                    change = await stream.try_next()
+                    if change is None:
+                        break
+                    operation = change["operationType"]
+                    if operation in ("drop", "rename", "invalidate"):
+                        return None
+                    if operation not in ("insert", "update", "replace", "delete"):
+                        continue
+
+                    document = change.get("fullDocument")
+                    if document is None:
+                        # deleted, or deleted again before the update could be looked up
+                        requests.append(DeleteOne({"_id": change["documentKey"]["_id"]}))
+                    else:
+                        requests.append(ReplaceOne({"_id": document["_id"]}, document, upsert=True))
+
+                    if len(requests) >= self.batch_size:
+                        await target[name].bulk_write(requests)
+                        applied += len(requests)
+                        requests = []
+                if requests:
+                    await target[name].bulk_write(requests)
+                    applied += len(requests)
+                return applied, stream.resume_token
+        except PyMongoError:
+            return None
+
+    async def _copy_all(
+        self, ctx, source, target, collections, verb: str, marks: dict = None, prefix: str = ""
+    ):
+        """
+        Copy collections concurrently, with at most `workers` collections or shards in flight.
+
+        If `marks` is given, collections that have a resume token in it only get the changes
+        since then, and the tokens are updated in place for the next run.
+        Documents are written to `prefix` + the collection name in the target.
+        """
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def copy_shard(name, query):
+            async with semaphore:
+                return await self._copy_collection(source, target, name, query, prefix)
+
+        async def copy(name):
+            start = time.perf_counter()
+            if marks is not None:
+                if name in marks:
+                    async with semaphore:
+                        result = await self._apply_changes(source, target, name, marks[name])
+                    if result is not None:
+                        applied, marks[name] = result
+                        await ctx.send(
+                            embed=await self.generate_embed(
+                                f"Updated `{name}` ({applied} changes since the last backup)"
+                            )
+                        )
+                        return applied
+
+                # taken before copying so nothing written during the copy is missed
+                token = await self._resume_token(source[name])
+                if token is None:
+                    marks.pop(name, None)
+                else:
+                    marks[name] = token
+                await target[name].drop()
+
+            # splitting a large collection scans its _id index, that counts as one of the workers
+            async with semaphore:
+                shards = await self._shards(source[name])
+            results = await asyncio.gather(*(copy_shard(name, query) for query in shards))
+            copied = sum(c for c, _ in results)
+            await ctx.send(
+                embed=await self.generate_embed(
+                    f"{verb} `{name}` ({self._rate(copied, time.perf_counter() - start)})"
+                )
+            )
+            return copied
+
+        start = time.perf_counter()
+        totals = await asyncio.gather(
+            *(copy(str(c)) for c in collections if c != "system.indexes")
+        )
+        return sum(totals), time.perf_counter() - start
+
+    @staticmethod
+    def _rate(copied: int, elapsed: float) -> str:
+        return f"{copied} documents, {copied / elapsed if elapsed else copied:.0f} docs/s"
+
+    @classmethod
+    async def _index_models(cls, collection) -> list:
+        """
+        Get the indexes of a collection (except the _id one) as IndexModels to recreate them.
+        """
+        return cls._to_index_models(await collection.index_information())
+
+    @staticmethod
+    def _to_index_models(information: dict) -> list:
+        """
+        Turn the output of `index_information` into IndexModels, the _id index is skipped.
+        """
+        models = []
+        for name, info in information.items():
+            if name == "_id_":
+                continue
+            # archived index information has its key pairs as lists
+            keys = [tuple(k) for k in info["key"]]
+            if "weights" in info:
+                # text indexes report their internal keys, rebuild them from the weights
+                keys = [k for k in keys if k[0] not in ("_fts", "_ftsx")]
+                keys += [(field, "text") for field in info["weights"]]
+            options = {k: v for k, v in info.items() if k not in ("key", "v", "ns")}
+            models.append(IndexModel(keys, name=name, **options))
+        return models
+
+    async def _create_staging(self, names: list):
+        """
+        Create empty staging collections, dropping the leftovers of an interrupted restore.
+        """
+        for name in names:
+            await self.bot.db[self.staging_prefix + name].drop()
+            await self.bot.db.create_collection(self.staging_prefix + name)
+
+    async def _drop_staging(self, names: list):
+        for name in names:
+            await self.bot.db[self.staging_prefix + name].drop()
+
+    async def _index_staging(self, names: list, backup=None, indexes: dict = None):
+        """
+        Build the indexes of the live collections on the staging ones, after the bulk inserts.
+
+        Indexes are taken from `backup`, or else from the `index_information` output stored
+        for the collection in `indexes`, if there is no live collection.
+        """
+        for name in names:
+            models = await self._index_models(self.bot.db[name])
+            if not models and backup is not None:
+                models = await self._index_models(backup[name])
+            if not models and indexes and name in indexes:
+                models = self._to_index_models(indexes[name])
+            if models:
+                await self.bot.db[self.staging_prefix + name].create_indexes(models)
+
+    async def _swap_in(self, names: list):
+        """
+        Rename the staging collections over the live ones, each rename is atomic.
+
+        Live collections that aren't being restored are dropped, like a full restore always did.
+        """
+        swapped = 0
+        for name in names:
+            try:
+                await self.bot.db[self.staging_prefix + name].rename(name, dropTarget=True)
+            except Exception as e:
+                raise RuntimeError(
+                    f"{swapped}/{len(names)} collections were swapped in, `{name}` failed: {e}"
+                ) from e
+            swapped += 1
+        for name in await self.bot.db.list_collection_names():
+            if name in names or name == "system.indexes" or name.startswith(self.staging_prefix):
+                continue
+            await self.bot.db[name].drop()
+
+    @staticmethod
+    def _compress(data: bytes, compression: str) -> bytes:
+        if compression == "zstd":
+            return zstandard.ZstdCompressor().compress(data)
+        return gzip.compress(data)
+
+    @staticmethod
+    def _decompress(data: bytes, compression: str) -> bytes:
+        if compression == "zstd":
+            if zstandard is None:
+                raise RuntimeError("This archive needs the `zstandard` package to be restored")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
+
+    async def _write_chunk(
+        self, directory: str, name: str, index: int, documents: list, compression: str
+    ) -> dict:
+        """
+        Write documents to a compressed file of concatenated BSON, off the event loop.
+        """
+        extension = "zst" if compression == "zstd" else "gz"
+        filename = f"{name}.{index:05d}.bson.{extension}"
+
+        def write():
+            data = self._compress(b"".join(bson.encode(d) for d in documents), compression)
+            with open(os.path.join(directory, filename), "wb") as f:
+                f.write(data)
+            return hashlib.sha256(data).hexdigest()
+
+        checksum = await self.bot.loop.run_in_executor(None, write)
+        return {"file": filename, "count": len(documents), "sha256": checksum}
+
+    async def _read_chunk(self, directory: str, chunk: dict, compression: str) -> list:
+        def read():
+            with open(os.path.join(directory, chunk["file"]), "rb") as f:
+                data = f.read()
+            if hashlib.sha256(data).hexdigest() != chunk["sha256"]:
+                raise ValueError(f"`{chunk['file']}` doesn't match its checksum")
+            documents = bson.decode_all(self._decompress(data, compression))
+            if len(documents) != chunk["count"]:
+                raise ValueError(f"`{chunk['file']}` doesn't have {chunk['count']} documents")
+            return documents
 
-    @commands.group()
+        return await self.bot.loop.run_in_executor(None, read)
+
+    async def _verify_archive(self, directory: str, manifest: dict) -> list:
+        """
+        Check every file of an archive against the manifest, returns the files that don't match.
+        """
+
+        def verify():
+            invalid = []
+            for entry in manifest["collections"].values():
+                for chunk in entry["chunks"]:
+                    path = os.path.join(directory, chunk["file"])
+                    if not os.path.isfile(path):
+                        invalid.append(chunk["file"])
+                        continue
+                    sha = hashlib.sha256()
+                    with open(path, "rb") as f:
+                        for block in iter(lambda: f.read(1 << 20), b""):
+                            sha.update(block)
+                    if sha.hexdigest() != chunk["sha256"]:
+                        invalid.append(chunk["file"])
+            return invalid
+
+        return await self.bot.loop.run_in_executor(None, verify)
+
+    async def _archive_collection(self, directory: str, name: str, compression: str) -> dict:
+        """
+        Stream a collection into `chunk_size` sized archive files.
+        """
+        chunks = []
+        count = 0
+        batch = []
+        async for document in self.bot.db[name].find().batch_size(self.batch_size):
+            batch.append(document)
+            if len(batch) >= self.chunk_size:
+                chunks.append(await self._write_chunk(directory, name, len(chunks), batch, compression))
+                count += len(batch)
+                batch = []
+        if batch:
+            chunks.append(await self._write_chunk(directory, name, len(chunks), batch, compression))
+            count += len(batch)
+        return {"count": count, "chunks": chunks}
+
+    async def _restore_collection(
+        self, directory: str, name: str, entry: dict, compression: str, prefix: str = ""
+    ):
+        """
+        Restore a collection from its archive files, one file is held in memory at a time.
+        """
+        restored = 0
+        target = self.bot.db[prefix + name]
+        for chunk in entry["chunks"]:
+            documents = await self._read_chunk(directory, chunk, compression)
+            for i in range(0, len(documents), self.batch_size):
+                await target.insert_many(documents[i : i + self.batch_size], ordered=False)
+            restored += len(documents)
+        return restored
+
+    def _load_manifest(self, name: str):
+        directory = os.path.join(self.archive_path, os.path.basename(name))
+        try:
+            with open(os.path.join(directory, "manifest.json")) as f:
+                return directory, json.load(f)
+        except (OSError, ValueError):
+            return directory, None
+
+    @commands.group(invoke_without_command=True)
     @checks.has_permissions(PermissionLevel.OWNER)
     async def backup(self, ctx: commands.Context):
         """
         Backup Your Mongodb database using this command.
 
+        Only the changes since the last backup are copied, use `backup full` for a full snapshot.
+        """
+        await self._backup(ctx, full=False)
+
+    @backup.command(name="full")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def backup_full(self, ctx: commands.Context):
+        """
+        Take a full snapshot of your Mongodb database.
+
         **Deletes Existing data from the backup db**
         """
-        if ctx.invoked_subcommand is None:
-            if self.running is True:
-                await ctx.send(
-                    "A backup/restore process is already running, please wait until it finishes"
-                )
-                return
-            if os.path.exists("./config.json"):
-                with open("./config.json") as f:
+        await self._backup(ctx, full=True)
 
-                    jd = json.load(f)
-                try:
-                    backup_url = jd["BACKUP_MONGO_URI"]
-                except KeyError:
-                    backup_url = os.getenv("BACKUP_MONGO_URI")
-                    if backup_url is None:
-                        await ctx.send(
-                            ":x: | No `BACKUP_MONGO_URI` found in `config.json` or environment variables, please add one.\nNote: Backup db is different from original db!"
-                        )
-                        return
-            else:
+    async def _backup(self, ctx: commands.Context, full: bool):
+        if self.running is True:
+            await ctx.send(
+                "A backup/restore process is already running, please wait until it finishes"
+            )
+            return
+        if os.path.exists("./config.json"):
+            with open("./config.json") as f:
+
+                jd = json.load(f)
+            try:
+                backup_url = jd["BACKUP_MONGO_URI"]
+            except KeyError:
                 backup_url = os.getenv("BACKUP_MONGO_URI")
                 if backup_url is None:
                     await ctx.send(
                         ":x: | No `BACKUP_MONGO_URI` found in `config.json` or environment variables, please add one.\nNote: Backup db is different from original db!"
                     )
                     return
-            self.running = True
+        else:
+            backup_url = os.getenv("BACKUP_MONGO_URI")
+            if backup_url is None:
+                await ctx.send(
+                    ":x: | No `BACKUP_MONGO_URI` found in `config.json` or environment variables, please add one.\nNote: Backup db is different from original db!"
+                )
+                return
+        self.running = True
+        try:
             db_name = (backup_url.split("/"))[-1]
             backup_client = AsyncIOMotorClient(backup_url)
             if "mlab.com" in backup_url:
                 bdb = backup_client[db_name]
             else:
                 bdb = backup_client["backup_modmail_bot"]
-            await ctx.send(
-                embed=await self.generate_embed(
-                    "Connected to backup DB. Removing all documents"
-                )
-            )
             collections = await bdb.list_collection_names()
 
-            if len(collections) > 0:
+            config = await self.db.find_one({"_id": "config"}) or {}
+            marks = {}
+            if not full:
+                # a mark is only usable if its collection is still in the backup db
+                marks = {
+                    mark["collection"]: mark["token"]
+                    for mark in config.get("highWaterMarks", [])
+                    if mark["collection"] in collections
+                }
+            if not full and marks:
+                await ctx.send(
+                    embed=await self.generate_embed(
+                        "Connected to backup DB. Copying the changes since the last backup"
+                    )
+                )
+            elif len(collections) > 0:
+                await ctx.send(
+                    embed=await self.generate_embed(
+                        "Connected to backup DB. Removing all documents"
+                    )
+                )
                 for collection in collections:
                     if collection == "system.indexes":
                         continue
@@ -83,25 +506,27 @@ class BackupDB(commands.Cog):
             else:
                 await ctx.send(
                     embed=await self.generate_embed(
-                        "No Existing collections found! Nothing was deleted!"
+                        "Connected to backup DB. No Existing collections found! Nothing was deleted!"
                     )
                 )
             du = await self.bot.db.list_collection_names()
-            for collection in du:
-                if collection == "system.indexes":
-                    continue
-
-                le = await self.bot.db[str(collection)].find().to_list(None)
-                for item in le:
-                    await bdb[str(collection)].insert_one(item)
-                    del item
-                del le
-                await ctx.send(
-                    embed=await self.generate_embed(f"Backed up `{str(collection)}`")
+            copied, elapsed = await self._copy_all(ctx, self.bot.db, bdb, du, "Backed up", marks)
+            await ctx.send(
+                embed=await self.generate_embed(
+                    f"Backed up all collections ({self._rate(copied, elapsed)})"
                 )
+            )
+            # stored as a list, collection names like plugins.<name> can't be used as keys
             await self.db.find_one_and_update(
                 {"_id": "config"},
-                {"$set": {"backedupAt": str(datetime.datetime.utcnow())}},
+                {
+                    "$set": {
+                        "backedupAt": str(datetime.datetime.utcnow()),
+                        "highWaterMarks": [
+                            {"collection": name, "token": token} for name, token in marks.items()
+                        ],
+                    }
+                },
                 upsert=True,
             )
             await ctx.send(
@@ -109,8 +534,15 @@ class BackupDB(commands.Cog):
                     f":tada: Backed Up Everything!\nTo restore your backup at any time, type `{self.bot.prefix}backup restore`."
                 )
             )
+        except Exception:
+            # some collections may be half copied, only a full snapshot can be trusted next time
+            await self.db.find_one_and_update(
+                {"_id": "config"}, {"$unset": {"highWaterMarks": ""}}
+            )
+            await ctx.send(":x: | Backup failed, the next backup will be a full snapshot.")
+            raise
+        finally:
             self.running = False
-            return
 
     @backup.command()
     @checks.has_permissions(PermissionLevel.OWNER)
@@ -132,7 +564,7 @@ class BackupDB(commands.Cog):
 
         config = await self.db.find_one({"_id": "config"})
 
-        if config is None or config["backedupAt"] is None:
+        if config is None or config.get("backedupAt") is None:
             await ctx.send("No previous backup found, exiting")
             return
 
@@ -147,76 +579,295 @@ class BackupDB(commands.Cog):
             await ctx.send("Exiting!")
             return
         self.running = True
-        if os.path.exists("./config.json"):
-            with open("./config.json") as f:
+        try:
+            if os.path.exists("./config.json"):
+                with open("./config.json") as f:
 
-                jd = json.load(f)
-            try:
-                backup_url = jd["BACKUP_MONGO_URI"]
-            except KeyError:
+                    jd = json.load(f)
+                try:
+                    backup_url = jd["BACKUP_MONGO_URI"]
+                except KeyError:
+                    backup_url = os.getenv("BACKUP_MONGO_URI")
+                    if backup_url is None:
+                        await ctx.send(
+                            ":x: | No `BACKUP_MONGO_URI` found in `config.json` or environment variables"
+                        )
+                        return
+            else:
                 backup_url = os.getenv("BACKUP_MONGO_URI")
                 if backup_url is None:
                     await ctx.send(
                         ":x: | No `BACKUP_MONGO_URI` found in `config.json` or environment variables"
                     )
                     return
-        else:
-            backup_url = os.getenv("BACKUP_MONGO_URI")
-            if backup_url is None:
+
+            db_name = (backup_url.split("/"))[-1]
+            backup_client = AsyncIOMotorClient(backup_url)
+            if "mlab.com" in backup_url:
+                bdb = backup_client[db_name]
+            else:
+                bdb = backup_client["backup_modmail_bot"]
+            await ctx.send(
+                embed=await self.generate_embed(
+                    "Connected to backup DB. Restoring into staging collections, "
+                    "the original db stays untouched until everything is copied."
+                )
+            )
+            du = [str(c) for c in await bdb.list_collection_names() if c != "system.indexes"]
+            try:
+                await self._create_staging(du)
+                copied, elapsed = await self._copy_all(
+                    ctx, bdb, self.bot.db, du, "Restored", prefix=self.staging_prefix
+                )
+                await self._index_staging(du, bdb)
+            except Exception as e:
+                await self._drop_staging(du)
+                await ctx.send(f":x: | Restore failed, the original db was not changed: {e}")
+                return
+            try:
+                await self._swap_in(du)
+            except Exception as e:
                 await ctx.send(
-                    ":x: | No `BACKUP_MONGO_URI` found in `config.json` or environment variables"
+                    f":x: | Restore failed while swapping the collections in, **the original db is only "
+                    f"partly restored**: {e}\nRun `{self.bot.prefix}backup restore` again to finish it."
                 )
                 return
+            await ctx.send(
+                embed=await self.generate_embed(
+                    f"Restored all collections ({self._rate(copied, elapsed)})"
+                )
+            )
+            await self.db.find_one_and_update(
+                {"_id": "config"},
+                # the live collections were replaced, the next backup has to start over
+                {
+                    "$set": {"restoredAt": str(datetime.datetime.utcnow())},
+                    "$unset": {"highWaterMarks": ""},
+                },
+                upsert=True,
+            )
+            await ctx.send(embed=await self.generate_embed(":tada: Restored Everything!"))
+        finally:
+            self.running = False
 
-        db_name = (backup_url.split("/"))[-1]
-        backup_client = AsyncIOMotorClient(backup_url)
-        if "mlab.com" in backup_url:
-            bdb = backup_client[db_name]
-        else:
-            bdb = backup_client["backup_modmail_bot"]
+    @backup.command(name="batch", aliases=["batchsize"])
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def batch(self, ctx: commands.Context, size: int):
+        """
+        Set how many documents are read and written at once while backing up or restoring.
+
+        Bigger batches are faster but use more memory.
+        """
+        if size <= 0:
+            await ctx.send(":x: | The batch size has to be a positive number.")
+            return
+
+        self.batch_size = size
+        await self.db.find_one_and_update(
+            {"_id": "config"},
+            {"$set": {"batchSize": size}},
+            upsert=True,
+        )
         await ctx.send(
-            embed=await self.generate_embed(
-                "Connected to backup DB. Removing all documents from original db."
-            )
+            embed=await self.generate_embed(f"Documents will be copied in batches of `{size}`.")
         )
-        collections = await self.bot.db.list_collection_names()
 
-        if len(collections) > 0:
-            for collection in collections:
-                if collection == "system.indexes":
-                    continue
+    @backup.group(name="archive", invoke_without_command=True)
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def archive(self, ctx: commands.Context):
+        """
+        Backup your Mongodb database to a compressed archive on the local disk.
 
-                await self.bot.db[collection].drop()
+        No `BACKUP_MONGO_URI` is needed, archives are stored in the `backups` folder.
+        """
+        if self.running is True:
             await ctx.send(
-                embed=await self.generate_embed("Deleted all documents from main db")
+                "A backup/restore process is already running, please wait until it finishes"
             )
-        else:
+            return
+        self.running = True
+        try:
+            name = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+            directory = os.path.join(self.archive_path, name)
+            os.makedirs(directory, exist_ok=True)
+            compression = "zstd" if zstandard is not None else "gzip"
             await ctx.send(
                 embed=await self.generate_embed(
-                    "No Existing collections found! Nothing was deleted!"
+                    f"Archiving all collections to `{name}` ({compression})"
                 )
             )
-        du = await bdb.list_collection_names()
-        for collection in du:
-            if collection == "system.indexes":
-                continue
 
-            le = await bdb[str(collection)].find().to_list(None)
-            for item in le:
-                await self.bot.db[str(collection)].insert_one(item)
-                del item
-            del le
+            semaphore = asyncio.Semaphore(self.workers)
+
+            async def archive_one(collection):
+                async with semaphore:
+                    start = time.perf_counter()
+                    entry = await self._archive_collection(directory, collection, compression)
+                    # extended JSON keeps the BSON values of e.g. partial filter expressions
+                    entry["indexes"] = json.loads(
+                        json_util.dumps(await self.bot.db[collection].index_information())
+                    )
+                await ctx.send(
+                    embed=await self.generate_embed(
+                        f"Archived `{collection}` ({self._rate(entry['count'], time.perf_counter() - start)})"
+                    )
+                )
+                return collection, entry
+
+            start = time.perf_counter()
+            collections = [
+                str(c) for c in await self.bot.db.list_collection_names() if c != "system.indexes"
+            ]
+            entries = await asyncio.gather(*(archive_one(c) for c in collections))
+            manifest = {
+                "createdAt": str(datetime.datetime.utcnow()),
+                "format": "bson",
+                "compression": compression,
+                "collections": dict(entries),
+            }
+
+            def write_manifest():
+                with open(os.path.join(directory, "manifest.json"), "w") as f:
+                    json.dump(manifest, f, indent=2)
+
+            # written last, an archive without a manifest is incomplete
+            await self.bot.loop.run_in_executor(None, write_manifest)
+
+            total = sum(entry["count"] for _, entry in entries)
             await ctx.send(
-                embed=await self.generate_embed(f"Restored `{str(collection)}`")
+                embed=await self.generate_embed(
+                    f":tada: Archived Everything! ({self._rate(total, time.perf_counter() - start)})\n"
+                    f"To restore it at any time, type `{self.bot.prefix}backup archive restore {name}`."
+                )
+            )
+        finally:
+            self.running = False
+
+    @archive.command(name="list")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def archive_list(self, ctx: commands.Context):
+        """
+        List the local archives.
+        """
+        lines = []
+        if os.path.isdir(self.archive_path):
+            for name in sorted(os.listdir(self.archive_path), reverse=True):
+                _, manifest = self._load_manifest(name)
+                if manifest is None:
+                    continue
+                count = sum(entry["count"] for entry in manifest["collections"].values())
+                lines.append(f"`{name}` - {count} documents, {manifest['compression']}")
+
+        if not lines:
+            await ctx.send("No archives found")
+            return
+        await ctx.send(embed=await self.generate_embed("\n".join(lines[:20])))
+
+    @archive.command(name="restore")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def archive_restore(self, ctx: commands.Context, name: str):
+        """
+        Restore your Mongodb database from a local archive.
+
+        **Deletes Existing data from the original db and overwrites it with data in the archive**
+        """
+
+        def check(msg: discord.Message):
+            return ctx.author == msg.author and ctx.channel == msg.channel
+
+        if self.running is True:
+            await ctx.send(
+                "A backup/restore process is already running, please wait until it finishes"
+            )
+            return
+
+        directory, manifest = self._load_manifest(name)
+        if manifest is None:
+            await ctx.send(f"No archive named `{name}` found, exiting")
+            return
+
+        await ctx.send(
+            embed=await self.generate_embed(
+                f"Are you sure you wanna restore data from the archive which"
+                f" was created on **{manifest['createdAt']} UTC**? `[y/n]`"
             )
-        await self.db.find_one_and_update(
-            {"_id": "config"},
-            {"$set": {"restoredAt": str(datetime.datetime.utcnow())}},
-            upsert=True,
         )
-        await ctx.send(embed=await self.generate_embed(":tada: Restored Everything!"))
-        self.running = False
-        return
+        msg: discord.Message = await self.bot.wait_for("message", check=check)
+        if msg.content.lower() == "n":
+            await ctx.send("Exiting!")
+            return
+
+        self.running = True
+        try:
+            # checked before anything is deleted
+            invalid = await self._verify_archive(directory, manifest)
+            if invalid:
+                await ctx.send(
+                    ":x: | The archive is damaged, these files are missing or don't match their checksum: "
+                    + ", ".join(f"`{file}`" for file in invalid[:10])
+                )
+                return
+            if manifest["compression"] == "zstd" and zstandard is None:
+                await ctx.send(":x: | This archive needs the `zstandard` package to be restored.")
+                return
+
+            await ctx.send(
+                embed=await self.generate_embed(
+                    "Archive verified. Restoring into staging collections, "
+                    "the original db stays untouched until everything is copied."
+                )
+            )
+
+            semaphore = asyncio.Semaphore(self.workers)
+
+            async def restore_one(collection, entry):
+                async with semaphore:
+                    return await self._restore_collection(
+                        directory, collection, entry, manifest["compression"], self.staging_prefix
+                    )
+
+            start = time.perf_counter()
+            names = list(manifest["collections"])
+            try:
+                await self._create_staging(names)
+                counts = await asyncio.gather(
+                    *(restore_one(c, entry) for c, entry in manifest["collections"].items())
+                )
+                # archives made before index definitions were stored don't have them
+                indexes = {
+                    c: json_util.loads(json.dumps(entry["indexes"]))
+                    for c, entry in manifest["collections"].items()
+                    if "indexes" in entry
+                }
+                await self._index_staging(names, indexes=indexes)
+            except Exception as e:
+                await self._drop_staging(names)
+                await ctx.send(f":x: | Restore failed, the original db was not changed: {e}")
+                return
+            try:
+                await self._swap_in(names)
+            except Exception as e:
+                await ctx.send(
+                    f":x: | Restore failed while swapping the collections in, **the original db is only "
+                    f"partly restored**: {e}\nRun `{self.bot.prefix}backup archive restore {name}` "
+                    f"again to finish it."
+                )
+                return
+            await self.db.find_one_and_update(
+                {"_id": "config"},
+                {
+                    "$set": {"restoredAt": str(datetime.datetime.utcnow())},
+                    "$unset": {"highWaterMarks": ""},
+                },
+                upsert=True,
+            )
+            await ctx.send(
+                embed=await self.generate_embed(
+                    f":tada: Restored Everything! ({self._rate(sum(counts), time.perf_counter() - start)})"
+                )
+            )
+        finally:
+            self.running = False
 
     async def generate_embed(self, msg: str):
         embed = discord.Embed(description=msg, color=discord.Colour.blurple())
@@ -1,9 +1,15 @@
 import asyncio
+import bisect
+import functools
+import heapq
+import itertools
+import logging
 import re
 import random
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 from inspect import Parameter
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 from typing import Iterable, List, Mapping, Tuple, Dict, Set, Literal
 from urllib.parse import quote_plus
 
@@ -12,11 +18,12 @@ from fuzzywuzzy import process
 
 from redbot.core import Config, checks, commands
 from redbot.core.i18n import Translator, cog_i18n
-from redbot.core.utils import menus, AsyncIter
+from redbot.core.utils import menus
 from redbot.core.utils.chat_formatting import box, pagify, escape, humanize_list
 from redbot.core.utils.predicates import MessagePredicate
 
 _ = Translator("CustomCommands", __file__)
+log = logging.getLogger("red.customcom")
 
 
 class CCError(Exception):
@@ -43,36 +50,272 @@ class CommandNotEdited(CCError):
     pass
 
 
+_PLACEHOLDER_RE = re.compile(r"{([^}]+)\}")
+_ARG_RE = re.compile(r"(\d+)[^.}]*(\.[^:}]+)?[^}]*")
+
+
+class CCTemplate:
+    """A custom command response split into literal text and placeholders.
+
+    Built once per response, so invoking a command only has to fill in the placeholders.
+    """
+
+    __slots__ = ("nodes", "params")
+
+    def __init__(self, raw_response: str):
+        # str for literal text, (result,) for message placeholders like {author.name}
+        # and (result, index, attr) for argument placeholders like {0.name}
+        self.nodes: List = []
+        self.params: Mapping[str, Parameter] = CustomCommands.prepare_args(raw_response)
+
+        matches = [
+            (match, _ARG_RE.fullmatch(match.group(1)))
+            for match in _PLACEHOLDER_RE.finditer(raw_response)
+        ]
+        indices = [int(arg.group(1)) for _, arg in matches if arg]
+        low = min(indices) if indices else 0
+
+        pos = 0
+        for match, arg in matches:
+            if match.start() > pos:
+                self.nodes.append(raw_response[pos : match.start()])
+            result = match.group(1)
+            if arg:
+                self.nodes.append((result, int(arg.group(1)) - low, arg.group(2) or ""))
+            else:
+                self.nodes.append((result,))
+            pos = match.end()
+        if pos < len(raw_response):
+            self.nodes.append(raw_response[pos:])
+
+
+class CooldownStore:
+    """Cooldown expiry times keyed by ids.
+
+    Expired entries are swept lazily from a min-heap whenever the store is accessed,
+    so it only ever holds the cooldowns that are still running.
+    """
+
+    def __init__(self):
+        self._expiries: Dict[Tuple, float] = {}
+        self._heap: List[Tuple[float, Tuple]] = []
+
+    def __len__(self) -> int:
+        self.sweep()
+        return len(self._expiries)
+
+    def __contains__(self, key: Tuple) -> bool:
+        return self._expiries.get(key, 0) > time.monotonic()
+
+    def sweep(self, now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+        while self._heap and self._heap[0][0] <= now:
+            expiry, key = heapq.heappop(self._heap)
+            if self._expiries.get(key) == expiry:
+                del self._expiries[key]
+
+    def set(self, key: Tuple, expiry: float) -> None:
+        self._expiries[key] = expiry
+        heapq.heappush(self._heap, (expiry, key))
+
+
+class SearchIndex:
+    """Inverted index over the names and responses of a guild's custom commands.
+
+    Kept up to date on create, edit and delete, so searching doesn't have to go over every command.
+    """
+
+    NAME_WEIGHT = 3
+    RESPONSE_WEIGHT = 1
+
+    def __init__(self):
+        # token -> {command name: weight}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        # command name -> its tokens, to remove them again
+        self._tokens: Dict[str, Set[str]] = {}
+        # all tokens in order for prefix matches, rebuilt lazily after changes
+        self._sorted: List[str] = []
+        self._dirty = False
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return re.findall(r"\w+", text.lower())
+
+    def add(self, command: str, ccinfo: dict) -> None:
+        self.remove(command)
+        responses = ccinfo["response"]
+        if isinstance(responses, str):
+            responses = [responses]
+        weights = Counter()
+        for token in self.tokenize(command):
+            weights[token] += self.NAME_WEIGHT
+        for response in responses:
+            for token in self.tokenize(response):
+                weights[token] += self.RESPONSE_WEIGHT
+        for token, weight in weights.items():
+            self._postings.setdefault(token, {})[command] = weight
+        self._tokens[command] = set(weights)
+        self._dirty = True
+
+    def remove(self, command: str) -> None:
+        for token in self._tokens.pop(command, ()):
+            postings = self._postings[token]
+            del postings[command]
+            if not postings:
+                del self._postings[token]
+            self._dirty = True
+
+    def search(self, query: str, limit: int = 10) -> List[str]:
+        """Get the best matching command names, exact tokens rank above prefix matches."""
+        if self._dirty:
+            self._sorted = sorted(self._postings)
+            self._dirty = False
+
+        scores = Counter()
+        for word in set(self.tokenize(query)):
+            start = bisect.bisect_left(self._sorted, word)
+            for token in itertools.takewhile(
+                lambda t: t.startswith(word), itertools.islice(self._sorted, start, None)
+            ):
+                factor = 2 if token == word else 1
+                for command, weight in self._postings[token].items():
+                    scores[command] += weight * factor
+        return [command for command, _ in scores.most_common(limit)]
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_response(raw_response: str) -> CCTemplate:
+    """Get the compiled template of a response, raises ArgParseError for invalid arguments."""
+    return CCTemplate(raw_response)
+
+
 class CommandObj:
     def __init__(self, **kwargs):
         self.config = kwargs.get("config")
         self.bot = kwargs.get("bot")
         self.db = self.config.guild
+        # guild id -> {command name: ccinfo}, loaded on first use and kept in sync on every write
+        self._tables: Dict[int, Dict[str, dict]] = {}
+        self._indexes: Dict[int, SearchIndex] = {}
+        # user id -> {(guild id, command name)} they authored or edited, built on first redaction
+        self._authored: Dict[int, Set[Tuple[int, str]]] = None
 
     @staticmethod
     async def get_commands(config) -> dict:
         _commands = await config.commands()
         return {k: v for k, v in _commands.items() if _commands[k]}
 
-    async def redact_author_ids(self, user_id: int):
+    async def get_table(self, guild: discord.Guild) -> Dict[str, dict]:
+        """Get the custom commands of a guild, only the first call per guild reads the config."""
+        table = self._tables.get(guild.id)
+        if table is None:
+            table = self._tables[guild.id] = await self.get_commands(self.db(guild))
+        return table
+
+    async def get_index(self, guild: discord.Guild) -> SearchIndex:
+        """Get the search index of a guild, built from its command table on first use."""
+        index = self._indexes.get(guild.id)
+        if index is None:
+            index = SearchIndex()
+            for command, ccinfo in (await self.get_table(guild)).items():
+                index.add(command, ccinfo)
+            self._indexes[guild.id] = index
+        return index
+
+    async def _store(self, guild: discord.Guild, command: str, ccinfo: dict):
+        await self.db(guild).commands.set_raw(command, value=ccinfo)
+        table = await self.get_table(guild)
+        self._index_authors(guild.id, command, table.get(command), remove=True)
+        self._index_authors(guild.id, command, ccinfo)
+        table[command] = ccinfo
+        if guild.id in self._indexes:
+            self._indexes[guild.id].add(command, ccinfo)
+
+    def _index_authors(self, guild_id: int, command: str, ccinfo: dict, remove: bool = False):
+        if self._authored is None or not ccinfo:
+            return
+        user_ids = {ccinfo.get("author", {}).get("id", 0), *ccinfo.get("editors", [])}
+        for user_id in user_ids - {0, 0xDE1}:
+            if remove:
+                self._authored.get(user_id, set()).discard((guild_id, command))
+            else:
+                self._authored.setdefault(user_id, set()).add((guild_id, command))
+
+    async def _get_authored(self) -> Dict[int, Set[Tuple[int, str]]]:
+        if self._authored is None:
+            self._authored = {}
+            for guild_id, guild_data in (await self.config.all_guilds()).items():
+                for command, ccinfo in guild_data.get("commands", {}).items():
+                    self._index_authors(guild_id, command, ccinfo)
+        return self._authored
+
+    async def _redact_command(self, guild_id: int, command: str, user_id: int):
+        group = self.config.guild_from_id(guild_id).commands
+        com_info = await group.get_raw(command, default=None)
+        if not com_info:
+            return
+
+        if com_info.get("author", {}).get("id", 0) == user_id:
+            com_info["author"]["id"] = 0xDE1
+            com_info["author"]["name"] = "Deleted User"
 
-        all_guilds = await self.config.all_guilds()
+        if editors := com_info.get("editors", None):
+            for index, editor_id in enumerate(editors):
+                if editor_id == user_id:
+                    editors[index] = 0xDE1
 
-        for guild_id in all_guilds.keys():
+        await group.set_raw(command, value=com_info)
+        table = self._tables.get(guild_id)
+        if table is not None and command in table:
+            table[command] = com_info
+
+    async def redact_author_ids(self, user_id: int, *, chunk_size: int = 100) -> int:
+        """Redact a user from the custom commands they created or edited.
+
+        Only the affected commands are rewritten, found through the author index.
+        The remaining work is saved after every chunk, so an interrupted redaction
+        picks up where it left off the next time it runs.
+
+        Returns
+        --------
+        int
+            The number of commands that were redacted.
+        """
+        start = time.perf_counter()
+        key = str(user_id)
+        pending = await self.config.pending_redactions()
+        if key in pending:
+            remaining = [tuple(entry) for entry in pending[key]]
+        else:
+            remaining = sorted((await self._get_authored()).get(user_id, ()))
+            await self.config.pending_redactions.set_raw(key, value=remaining)
+
+        total = len(remaining)
+        done = 0
+        while remaining:
+            chunk, remaining = remaining[:chunk_size], remaining[chunk_size:]
+            for guild_id, command in chunk:
+                await self._redact_command(guild_id, command, user_id)
+            done += len(chunk)
+            await self.config.pending_redactions.set_raw(key, value=remaining)
+            log.debug("Redacted user %s from %s/%s custom commands", user_id, done, total)
             await asyncio.sleep(0)
-            async with self.config.guild_from_id(guild_id).commands() as all_commands:
-                async for com_name, com_info in AsyncIter(all_commands.items(), steps=100):
-                    if not com_info:
-                        continue
 
-                    if com_info.get("author", {}).get("id", 0) == user_id:
-                        com_info["author"]["id"] = 0xDE1
-                        com_info["author"]["name"] = "Deleted User"
+        await self.config.pending_redactions.clear_raw(key)
+        if self._authored is not None:
+            self._authored.pop(user_id, None)
+        log.info(
+            "Redacted user %s from %s custom commands in %.2f seconds",
+            user_id,
+            total,
+            time.perf_counter() - start,
+        )
+        return total
 
-                    if editors := com_info.get("editors", None):
-                        for index, editor_id in enumerate(editors):
-                            if editor_id == user_id:
-                                editors[index] = 0xDE1
+    async def resume_redactions(self):
+        """Finish the redactions that were interrupted, e.g. by a restart."""
+        for key in await self.config.pending_redactions():
+            await self.redact_author_ids(int(key))
 
     async def get_responses(self, ctx):
         intro = _(
@@ -113,14 +356,14 @@ class CommandObj:
     async def get(self, message: discord.Message, command: str) -> Tuple[str, Dict]:
         if not command:
             raise NotFound()
-        ccinfo = await self.db(message.guild).commands.get_raw(command, default=None)
+        ccinfo = (await self.get_table(message.guild)).get(command)
         if not ccinfo:
             raise NotFound()
         else:
             return ccinfo["response"], ccinfo.get("cooldowns", {})
 
     async def get_full(self, message: discord.Message, command: str) -> Dict:
-        ccinfo = await self.db(message.guild).commands.get_raw(command, default=None)
+        ccinfo = (await self.get_table(message.guild)).get(command)
         if ccinfo:
             return ccinfo
         else:
@@ -129,10 +372,11 @@ class CommandObj:
     async def create(self, ctx: commands.Context, command: str, *, response):
         """Create a custom command"""
         # Check if this command is already registered as a customcommand
-        if await self.db(ctx.guild).commands.get_raw(command, default=None):
+        if command in await self.get_table(ctx.guild):
             raise AlreadyExists()
-        # test to raise
-        ctx.cog.prepare_args(response if isinstance(response, str) else response[0])
+        # compile the responses up front, this also raises for invalid arguments
+        for r in [response] if isinstance(response, str) else response:
+            compile_response(r)
         author = ctx.message.author
         ccinfo = {
             "author": {"id": author.id, "name": str(author)},
@@ -142,7 +386,7 @@ class CommandObj:
             "editors": [],
             "response": response,
         }
-        await self.db(ctx.guild).commands.set_raw(command, value=ccinfo)
+        await self._store(ctx.guild, command, ccinfo)
 
     async def edit(
         self,
@@ -185,8 +429,9 @@ class CommandObj:
                 response = resp.content
 
         if response:
-            # test to raise
-            ctx.cog.prepare_args(response if isinstance(response, str) else response[0])
+            # compile the responses up front, this also raises for invalid arguments
+            for r in [response] if isinstance(response, str) else response:
+                compile_response(r)
             ccinfo["response"] = response
 
         if cooldowns:
@@ -202,14 +447,18 @@ class CommandObj:
 
         ccinfo["edited_at"] = self.get_now()
 
-        await self.db(ctx.guild).commands.set_raw(command, value=ccinfo)
+        await self._store(ctx.guild, command, ccinfo)
 
     async def delete(self, ctx: commands.Context, command: str):
         """Delete an already existing custom command"""
         # Check if this command is registered
-        if not await self.db(ctx.guild).commands.get_raw(command, default=None):
+        if command not in await self.get_table(ctx.guild):
             raise NotFound()
         await self.db(ctx.guild).commands.set_raw(command, value=None)
+        ccinfo = (await self.get_table(ctx.guild)).pop(command, None)
+        self._index_authors(ctx.guild.id, command, ccinfo, remove=True)
+        if ctx.guild.id in self._indexes:
+            self._indexes[ctx.guild.id].remove(command)
 
 
 @cog_i18n(_)
@@ -226,8 +475,12 @@ class CustomCommands(commands.Cog):
         self.key = 414589031223512
         self.config = Config.get_conf(self, self.key)
         self.config.register_guild(commands={})
+        self.config.register_global(pending_redactions={})
         self.commandobj = CommandObj(config=self.config, bot=self.bot)
-        self.cooldowns = {}
+        self.bot.loop.create_task(self.commandobj.resume_redactions())
+        self.cooldowns = CooldownStore()
+        # (name, response) -> the command invoked for it, most recently used last
+        self._fake_commands: "OrderedDict[Tuple[str, str], commands.Command]" = OrderedDict()
 
     async def red_delete_data_for_user(
         self,
@@ -252,7 +505,7 @@ class CustomCommands(commands.Cog):
         This is helpful for copy and pasting.
         **Arguments:**
         - `<command>` The custom command to get the raw response of."""
-        commands = await self.config.guild(ctx.guild).commands()
+        commands = await self.commandobj.get_table(ctx.guild)
         if command not in commands:
             return await ctx.send("That command doesn't exist.")
         command = commands[command]
@@ -293,20 +546,23 @@ class CustomCommands(commands.Cog):
     async def cc_search(self, ctx: commands.Context, *, query):
         """
         Searches through custom commands, according to the query.
-        Uses fuzzywuzzy searching to find close matches.
+        Matches words in command names and responses, and falls back
+        to fuzzywuzzy searching on names to find close matches.
         **Arguments:**
         - `<query>` The query to search for. Can be multiple words.
         """
-        cc_commands = await CommandObj.get_commands(self.config.guild(ctx.guild))
-        extracted = process.extract(query, list(cc_commands.keys()))
-        accepted = []
-        for entry in extracted:
-            if entry[1] > 60:
-                # Match was decently strong
-                accepted.append((entry[0], cc_commands[entry[0]]))
-            else:
-                # Match wasn't strong enough
-                pass
+        cc_commands = await self.commandobj.get_table(ctx.guild)
+        index = await self.commandobj.get_index(ctx.guild)
+        accepted = [(name, cc_commands[name]) for name in index.search(query)]
+        if not accepted:
+            extracted = process.extract(query, list(cc_commands.keys()))
+            for entry in extracted:
+                if entry[1] > 60:
+                    # Match was decently strong
+                    accepted.append((entry[0], cc_commands[entry[0]]))
+                else:
+                    # Match wasn't strong enough
+                    pass
         if len(accepted) == 0:
             return await ctx.send(_("No close matches were found."))
         results = self.prepare_command_list(ctx, accepted)
@@ -481,7 +737,7 @@ class CustomCommands(commands.Cog):
         The list displays a preview of each command's response, with
         markdown escaped and newlines replaced with spaces.
         """
-        cc_dict = await CommandObj.get_commands(self.config.guild(ctx.guild))
+        cc_dict = await self.commandobj.get_table(ctx.guild)
 
         if not cc_dict:
             await ctx.send(
@@ -580,6 +836,10 @@ class CustomCommands(commands.Cog):
         if await self.bot.cog_disabled_in_guild(self, message.guild):
             return
 
+        # only build a context for messages that can invoke a custom command
+        if not await self.might_invoke(message):
+            return
+
         ctx = await self.bot.get_context(message)
 
         if ctx.prefix is None:
@@ -600,16 +860,48 @@ class CustomCommands(commands.Cog):
         except CCError:
             return
 
-        # wrap the command here so it won't register with the bot
-        fake_cc = commands.command(name=ctx.invoked_with)(self.cc_callback)
-        fake_cc.params = self.prepare_args(raw_response)
-        fake_cc.requires.ready_event.set()
-        ctx.command = fake_cc
+        try:
+            ctx.command = self.get_fake_command(ctx.invoked_with, raw_response)
+        except ArgParseError:
+            return
 
         await self.bot.invoke(ctx)
         if not ctx.command_failed:
             await self.cc_command(*ctx.args, **ctx.kwargs, raw_response=raw_response)
 
+    async def might_invoke(self, message: discord.Message) -> bool:
+        """Check whether a message starts with a prefix followed by a custom command name.
+
+        This is a lot cheaper than building a context for every message.
+        """
+        table = await self.commandobj.get_table(message.guild)
+        if not table:
+            return False
+        content = message.content
+        for prefix in await self.bot.get_valid_prefixes(message.guild):
+            if not content.startswith(prefix):
+                continue
+            rest = content[len(prefix) :]
+            if rest and not rest[0].isspace() and rest.split(maxsplit=1)[0] in table:
+                return True
+        return False
+
+    def get_fake_command(self, name: str, raw_response: str) -> commands.Command:
+        """Get the command object a response is invoked with, built once per response."""
+        key = (name, raw_response)
+        fake_cc = self._fake_commands.get(key)
+        if fake_cc is None:
+            # wrap the command here so it won't register with the bot
+            fake_cc = commands.command(name=name)(self.cc_callback)
+            fake_cc.params = OrderedDict(compile_response(raw_response).params)
+            fake_cc.requires.ready_event.set()
+            if len(self._fake_commands) >= 1024:
+                self._fake_commands.popitem(last=False)
+            self._fake_commands[key] = fake_cc
+        else:
+            self._fake_commands.move_to_end(key)
+        return fake_cc
+
     async def cc_callback(self, *args, **kwargs) -> None:
         """
         Custom command.
@@ -620,18 +912,16 @@ class CustomCommands(commands.Cog):
 
     async def cc_command(self, ctx, *cc_args, raw_response, **cc_kwargs) -> None:
         cc_args = (*cc_args, *cc_kwargs.values())
-        results = re.findall(r"{([^}]+)\}", raw_response)
-        for result in results:
-            param = self.transform_parameter(result, ctx.message)
-            raw_response = raw_response.replace("{" + result + "}", param)
-        results = re.findall(r"{((\d+)[^.}]*(\.[^:}]+)?[^}]*)\}", raw_response)
-        if results:
-            low = min(int(result[1]) for result in results)
-            for result in results:
-                index = int(result[1]) - low
-                arg = self.transform_arg(result[0], result[2], cc_args[index])
-                raw_response = raw_response.replace("{" + result[0] + "}", arg)
-        await ctx.send(raw_response)
+        parts = []
+        for node in compile_response(raw_response).nodes:
+            if isinstance(node, str):
+                parts.append(node)
+            elif len(node) == 1:
+                parts.append(self.transform_parameter(node[0], ctx.message))
+            else:
+                result, index, attr = node
+                parts.append(self.transform_arg(result, attr, cc_args[index]))
+        await ctx.send("".join(parts))
 
     @staticmethod
     def prepare_args(raw_response) -> Mapping[str, Parameter]:
@@ -711,25 +1001,30 @@ class CustomCommands(commands.Cog):
         return OrderedDict(fin)
 
     def test_cooldowns(self, ctx, command, cooldowns):
-        now = datetime.utcnow()
-        new_cooldowns = {}
+        now = time.monotonic()
+        self.cooldowns.sweep(now)
+        new_cooldowns = []
         for per, rate in cooldowns.items():
+            # keyed by ids so the store doesn't keep discord objects alive
             if per == "guild":
-                key = (command, ctx.guild)
+                key = (command, per, ctx.guild.id)
             elif per == "channel":
-                key = (command, ctx.guild, ctx.channel)
+                key = (command, per, ctx.guild.id, ctx.channel.id)
             elif per == "member":
-                key = (command, ctx.guild, ctx.author)
+                key = (command, per, ctx.guild.id, ctx.author.id)
             else:
                 raise ValueError(per)
-            cooldown = self.cooldowns.get(key)
-            if cooldown:
-                cooldown += timedelta(seconds=rate)
-                if cooldown > now:
-                    raise OnCooldown()
-            new_cooldowns[key] = now
+            if key in self.cooldowns:
+                raise OnCooldown()
+            new_cooldowns.append((key, now + rate))
         # only update cooldowns if the command isn't on cooldown
-        self.cooldowns.update(new_cooldowns)
+        for key, expiry in new_cooldowns:
+            self.cooldowns.set(key, expiry)
+
+    @property
+    def cooldown_count(self) -> int:
+        """The number of cooldowns that are currently running, for monitoring."""
+        return len(self.cooldowns)
 
     @classmethod
     def transform_arg(cls, result, attr, obj) -> str:
@@ -784,7 +1079,7 @@ class CustomCommands(commands.Cog):
         Set[str]
             A set of all custom command names.
         """
-        return set(await CommandObj.get_commands(self.config.guild(guild)))
+        return set(await self.commandobj.get_table(guild))
 
     @staticmethod
     def prepare_command_list(
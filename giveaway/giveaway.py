@@ -1,14 +1,20 @@
 import asyncio
 import aiohttp
 import discord
+import heapq
 import math
 import random
 import time
+import typing
 from datetime import datetime
 from discord.ext import commands
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
 
 from core import checks
-from core.models import PermissionLevel
+from core.models import PermissionLevel, getLogger
+
+logger = getLogger(__name__)
 
 
 class GiveawayPlugin(commands.Cog):
@@ -20,157 +26,365 @@ class GiveawayPlugin(commands.Cog):
         self.bot: discord.Client = bot
         self.db = bot.plugin_db.get_partition(self)
         self.active_giveaways = {}
+        # seconds between countdown refreshes, 0 means use discord timestamps and never edit
+        self.refresh_interval = 60
+        # (end time, message id) of every active giveaway, stale entries are skipped when popped
+        self._schedule = []
+        self._wakeup = asyncio.Event()
+        self._scheduler_task = None
+        self._refresh_task = None
+        # message id -> failed attempts to end it, retried with an exponential backoff
+        self._end_attempts: typing.Dict[str, int] = {}
+        self.end_retry_delay = 30
+        # message id -> ids of the users who entered, kept up to date from reaction events
+        self.entrants: typing.Dict[str, typing.Set[int]] = {}
+        self.entrants_flush_delay = 10
+        # message id -> user id -> entered, the changes that haven't been written to the database yet
+        self._entrant_changes: typing.Dict[str, typing.Dict[int, bool]] = {}
+        self._flush_task = None
+        # message id -> set once the entrants loaded at startup were checked against the reactions
+        self._reconciled: typing.Dict[str, asyncio.Event] = {}
+        # message id -> (user id, added) events received while its reactions are being paged
+        self._entry_journal: typing.Dict[str, typing.List[typing.Tuple[int, bool]]] = {}
         asyncio.create_task(self._set_giveaways_from_db())
 
+    def cog_unload(self):
+        if self._scheduler_task is not None:
+            self._scheduler_task.cancel()
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        self.bot.loop.create_task(self._flush_entrants())
+
     async def _set_giveaways_from_db(self):
         config = await self.db.find_one({"_id": "config"})
         if config is None:
+            config = {"giveaways": dict()}
             await self.db.find_one_and_update(
                 {"_id": "config"},
-                {"$set": {"giveaways": dict()}},
+                {"$set": config},
                 upsert=True,
             )
 
+        self.refresh_interval = config.get("refresh_interval", 60)
         for key, giveaway in config.get("giveaways", {}).items():
             if key in self.active_giveaways:
                 continue
             self.active_giveaways[str(key)] = giveaway
-            self.bot.loop.create_task(self._handle_giveaway(giveaway))
+            self._reconciled[str(key)] = asyncio.Event()
+            heapq.heappush(self._schedule, (giveaway["time"], str(key)))
 
-    async def _update_db(self):
+        self._scheduler_task = self.bot.loop.create_task(self._run_scheduler())
+        self.bot.loop.create_task(self._reconcile_active_giveaways())
+
+    async def _save_giveaway(self, giveaway):
+        # only touch this giveaway's key so concurrent updates of other giveaways aren't overwritten
         await self.db.find_one_and_update(
             {"_id": "config"},
-            {"$set": {"giveaways": self.active_giveaways}},
+            {"$set": {f"giveaways.{giveaway['message']}": giveaway}},
             upsert=True,
         )
 
-    async def _handle_giveaway(self, giveaway):
-        if str(giveaway["message"]) not in self.active_giveaways:
-            return
+    async def _remove_giveaway(self, key: str):
+        self.active_giveaways.pop(key, None)
+        self._end_attempts.pop(key, None)
+        await self.db.find_one_and_update(
+            {"_id": "config"},
+            {"$unset": {f"giveaways.{key}": ""}},
+        )
 
-        async def get_random_user(users, _guild, _winners):
-            rnd = random.choice(users)
-            in_guild = _guild.get_member(rnd)
-            if rnd in _winners or in_guild is None or in_guild.id == self.bot.user.id:
-                idk = await get_random_user(users, _guild, _winners)
-                return idk
-            win = [] + _winners
-            win.append(rnd)
-            return win
+    def _schedule_giveaway(self, giveaway):
+        heapq.heappush(self._schedule, (giveaway["time"], str(giveaway["message"])))
+        self._wakeup.set()
+
+    async def _run_scheduler(self):
+        await self.bot.wait_until_ready()
+        next_refresh = time.time()
 
         while True:
-            if str(giveaway["message"]) not in self.active_giveaways:
-                break
-            channel: discord.TextChannel = self.bot.get_channel(
-                int(giveaway["channel"])
-            )
-            if channel is None:
-                try:
-                    self.active_giveaways.pop(str(giveaway["message"]))
-                    await self._update_db()
-                except:
-                    pass
+            self._wakeup.clear()
+            now = time.time()
+
+            while self._schedule and self._schedule[0][0] <= now:
+                _, key = heapq.heappop(self._schedule)
+                giveaway = self.active_giveaways.get(key)
+                if giveaway is None:
+                    continue
+                self.bot.loop.create_task(self._try_end_giveaway(giveaway))
+
+            if self.refresh_interval and now >= next_refresh:
+                # rate limited edits must not hold up giveaways that are due
+                if self._refresh_task is None or self._refresh_task.done():
+                    self._refresh_task = self.bot.loop.create_task(self._refresh_countdowns())
+                next_refresh = now + self.refresh_interval
+
+            timeouts = []
+            if self._schedule:
+                timeouts.append(self._schedule[0][0] - now)
+            if self.refresh_interval:
+                timeouts.append(next_refresh - now)
+
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(),
+                    max(0, min(timeouts)) if timeouts else None,
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def _try_end_giveaway(self, giveaway):
+        key = str(giveaway["message"])
+        try:
+            await self._end_giveaway(giveaway)
+        except Exception:
+            if key not in self.active_giveaways:
                 return
+            attempts = self._end_attempts.get(key, 0) + 1
+            self._end_attempts[key] = attempts
+            delay = min(self.end_retry_delay * 2 ** (attempts - 1), 3600)
+            logger.warning(
+                "Couldn't end giveaway %s, retrying in %d seconds.", key, delay, exc_info=True
+            )
+            heapq.heappush(self._schedule, (time.time() + delay, key))
+            self._wakeup.set()
+        else:
+            self._end_attempts.pop(key, None)
+
+    def _time_remaining(self, giveaway) -> str:
+        if not self.refresh_interval:
+            return f"<t:{int(giveaway['time'])}:R>"
+
+        g_time = max(0, giveaway["time"] - time.time())
+        return f"{math.floor(g_time // 86400)} Days, {math.floor(g_time // 3600 % 24)} Hours, {math.floor(g_time // 60 % 60)} Minutes, {math.floor(g_time % 60)} Seconds "
+
+    def _giveaway_embed(self, giveaway) -> discord.Embed:
+        embed = discord.Embed(colour=0x00FF00)
+        embed.title = giveaway["item"]
+        embed.description = (
+            f"React with 🎉 to enter the giveaway!\n\n"
+            f"Time Remaining: **{self._time_remaining(giveaway)}**"
+        )
+        embed.set_footer(
+            text=f"{giveaway['winners']} {'winners' if giveaway['winners'] > 1 else 'winner'} | Ends at"
+        )
+        embed.timestamp = datetime.fromtimestamp(giveaway["time"])
+        return embed
+
+    async def _refresh_countdowns(self):
+        now = time.time()
+        giveaways = [g for g in self.active_giveaways.values() if g["time"] > now]
+        results = await asyncio.gather(
+            *(self._refresh_countdown(g) for g in giveaways), return_exceptions=True
+        )
+
+        for giveaway, result in zip(giveaways, results):
+            if isinstance(result, (discord.NotFound, AttributeError)):
+                await self._remove_giveaway(str(giveaway["message"]))
+
+    async def _refresh_countdown(self, giveaway):
+        channel: discord.TextChannel = self.bot.get_channel(int(giveaway["channel"]))
+        message = channel.get_partial_message(int(giveaway["message"]))
+        await message.edit(embed=self._giveaway_embed(giveaway))
+
+    async def _end_giveaway(self, giveaway):
+        if str(giveaway["message"]) not in self.active_giveaways:
+            return
+
+        channel: discord.TextChannel = self.bot.get_channel(
+            int(giveaway["channel"])
+        )
+        if channel is None:
+            await self._remove_giveaway(str(giveaway["message"]))
+            return
+        try:
             message = await channel.fetch_message(giveaway["message"])
-            if message is None or not message.embeds or message.embeds[0] is None:
-                try:
-                    self.active_giveaways.pop(str(giveaway["message"]))
-                    await self._update_db()
-                except:
-                    pass
-                return
-            guild: discord.Guild = self.bot.get_guild(giveaway["guild"])
-            g_time = giveaway["time"] - time.time()
-
-            if g_time <= 0:
-                if len(message.reactions) <= 0:
-                    embed = message.embeds[0]
-                    embed.description = (
-                        f"Giveaway has ended!\n\nSadly no one participated :("
-                    )
-                    embed.set_footer(
-                        text=f"{giveaway['winners']} {'winners' if giveaway['winners'] > 1 else 'winner'} | Ended at"
-                    )
-                    await message.edit(embed=embed)
-                    break
+        except discord.NotFound:
+            message = None
+        if message is None or not message.embeds or message.embeds[0] is None:
+            await self._remove_giveaway(str(giveaway["message"]))
+            return
+        guild: discord.Guild = self.bot.get_guild(giveaway["guild"])
+        key = str(giveaway["message"])
+
+        # overdue giveaways are due right at startup, don't draw from a half loaded set
+        reconciled = self._reconciled.get(key)
+        if reconciled is not None:
+            await reconciled.wait()
+        entrants = await self._get_entrants(key, message)
+        winners = self._pick_winners(entrants, guild, giveaway["winners"])
+        # make sure the entrants are stored for rerolls, failing here is still safe to retry
+        await self._flush_entrants()
+
+        embed = message.embeds[0]
+        embed.set_footer(
+            text=f"{giveaway['winners']} {'winners' if giveaway['winners'] > 1 else 'winner'} | Ended at"
+        )
+        winners_text = ""
+        if not entrants:
+            embed.description = f"Giveaway has ended!\n\nSadly no one participated :("
+        elif not winners:
+            embed.description = (
+                f"Giveaway has ended!\n\nSadly none of the participants are in the server anymore :("
+            )
+        else:
+            for winner in winners:
+                winners_text += f"<@{winner}> "
+
+            embed.description = f"Giveaway has ended!\n\n**{'Winners' if len(winners) > 1 else 'Winner'}:** {winners_text} "
+            embed.set_footer(
+                text=f"{len(winners)} {'winners' if len(winners) > 1 else 'winner'} | Ended at"
+            )
+        await message.edit(embed=embed)
+
+        # the results are public from here on, ending it again would draw different winners
+        try:
+            await self._remove_giveaway(key)
+            if winners_text:
+                await channel.send(
+                    f"🎉 Congratulations {winners_text}, you have won **{giveaway['item']}**!"
+                )
+        except Exception:
+            logger.warning("Giveaway %s has ended, but announcing it failed.", key, exc_info=True)
+        finally:
+            self.entrants.pop(key, None)
+            self._entrant_changes.pop(key, None)
+
+    async def _get_entrants(self, key: str, message: discord.Message) -> typing.Set[int]:
+        if key in self.entrants:
+            return self.entrants[key]
+
+        doc = await self.db.find_one({"_id": key})
+        if doc is not None and "entrants" in doc:
+            return set(doc["entrants"])
+
+        # giveaways started before entrants were tracked
+        return await self._reconcile_entrants(key, message)
 
-                to_break = False
-
-                for r in message.reactions:
-                    if str(giveaway["message"]) not in self.active_giveaways:
-                        break
-
-                    if r.emoji == "🎉":
-                        reactions = r
-                        reacted_users = await reactions.users().flatten()
-                        if len(reacted_users) <= 1:
-                            embed = message.embeds[0]
-                            embed.description = (
-                                f"Giveaway has ended!\n\nSadly no one participated :("
-                            )
-                            embed.set_footer(
-                                text=f"{giveaway['winners']} {'winners' if giveaway['winners'] > 1 else 'winner'} | "
-                                f"Ended at"
-                            )
-                            await message.edit(embed=embed)
-                            del guild, channel, reacted_users, embed
-                            break
-
-                        # -1 cuz 1 for self
-                        if giveaway["winners"] > (len(reacted_users) - 1):
-                            giveaway["winners"] = len(reacted_users) - 1
-
-                        winners = []
-
-                        for index in range(len(reacted_users)):
-                            reacted_users[index] = reacted_users[index].id
-
-                        for _ in range(giveaway["winners"]):
-                            winners = await get_random_user(
-                                reacted_users, guild, winners
-                            )
-
-                        embed = message.embeds[0]
-                        winners_text = ""
-                        for winner in winners:
-                            winners_text += f"<@{winner}> "
-
-                        embed.description = f"Giveaway has ended!\n\n**{'Winners' if giveaway['winners'] > 1 else 'Winner'}:** {winners_text} "
-                        embed.set_footer(
-                            text=f"{giveaway['winners']} {'winners' if giveaway['winners'] > 1 else 'winner'} | "
-                            f"Ended at"
-                        )
-                        await message.edit(embed=embed)
-                        await channel.send(
-                            f"🎉 Congratulations {winners_text}, you have won **{giveaway['item']}**!"
-                        )
-                        try:
-                            self.active_giveaways.pop(str(giveaway["message"]))
-                            await self._update_db()
-                        except:
-                            pass
-                        del winners_text, winners, guild, channel, reacted_users, embed
-                        to_break = True
-                        break
-
-                if to_break:
+    async def _reconcile_entrants(self, key: str, message: discord.Message) -> typing.Set[int]:
+        """
+        Rebuild the entrants of a giveaway from its reactions, only needed for reactions the bot missed
+        """
+        journal = self._entry_journal.setdefault(key, [])
+        entrants = set()
+        try:
+            for r in message.reactions:
+                if r.emoji == "🎉":
+                    async for user in r.users():
+                        if user.id != self.bot.user.id:
+                            entrants.add(user.id)
                     break
+        finally:
+            self._entry_journal.pop(key, None)
+
+        # events received while paging are newer than or equal to what the pages showed
+        for user_id, added in journal:
+            if added:
+                entrants.add(user_id)
             else:
+                entrants.discard(user_id)
 
-                time_remaining = f"{math.floor(g_time // 86400)} Days, {math.floor(g_time // 3600 % 24)} Hours, {math.floor(g_time // 60 % 60)} Minutes, {math.floor(g_time % 60)} Seconds "
+        if key in self.active_giveaways:
+            self.entrants[key] = entrants
+        # the full list below already has the buffered changes, newer ones are buffered again
+        self._entrant_changes.pop(key, None)
+        await self.db.find_one_and_update(
+            {"_id": key},
+            {"$set": {"entrants": list(entrants)}},
+            upsert=True,
+        )
+        return entrants
+
+    async def _reconcile_active_giveaways(self):
+        await self.bot.wait_until_ready()
+
+        # the ones ending first are reconciled first
+        giveaways = sorted(self.active_giveaways.items(), key=lambda item: item[1]["time"])
+        for key, giveaway in giveaways:
+            try:
+                doc = await self.db.find_one({"_id": key})
+                # giveaways that predate tracking are only added once their reactions are paged
+                if doc is not None and "entrants" in doc:
+                    self.entrants.setdefault(key, set(doc["entrants"]))
+
+                channel: discord.TextChannel = self.bot.get_channel(int(giveaway["channel"]))
+                if channel is None:
+                    continue
+                try:
+                    message = await channel.fetch_message(int(key))
+                except discord.HTTPException:
+                    continue
+                await self._reconcile_entrants(key, message)
+            except Exception:
+                logger.warning("Couldn't reconcile the entrants of giveaway %s.", key, exc_info=True)
+            finally:
+                reconciled = self._reconciled.pop(key, None)
+                if reconciled is not None:
+                    reconciled.set()
+
+    async def _flush_entrants(self):
+        if not self._entrant_changes:
+            return
 
-                embed = message.embeds[0]
-                embed.description = (
-                    f"React with 🎉 to enter the giveaway!\n\n"
-                    f"Time Remaining: **{time_remaining}**"
-                )
-                await message.edit(embed=embed)
-                del channel, guild
-                await asyncio.sleep(
-                    60 if g_time > 60 else (5 if g_time > 5 else g_time)
+        # only the changes are written, so a flush costs the same however many entrants there are
+        changes, self._entrant_changes = self._entrant_changes, {}
+        requests = []
+        for key, users in changes.items():
+            added = [user_id for user_id, entered in users.items() if entered]
+            removed = [user_id for user_id, entered in users.items() if not entered]
+            if added:
+                requests.append(
+                    UpdateOne({"_id": key}, {"$addToSet": {"entrants": {"$each": added}}}, upsert=True)
                 )
+            if removed:
+                requests.append(UpdateOne({"_id": key}, {"$pullAll": {"entrants": removed}}))
 
-        return
+        if not requests:
+            return
+        try:
+            await self.db.bulk_write(requests, ordered=False)
+        except PyMongoError:
+            # written again with the next flush, changes made since then are newer and win
+            for key, users in changes.items():
+                pending = self._entrant_changes.setdefault(key, {})
+                for user_id, entered in users.items():
+                    pending.setdefault(user_id, entered)
+            raise
+
+    async def _flush_entrants_later(self):
+        await asyncio.sleep(self.entrants_flush_delay)
+        try:
+            await self._flush_entrants()
+        except PyMongoError:
+            logger.warning("Couldn't save the giveaway entrants, retrying with the next flush.", exc_info=True)
+
+    async def _handle_entry(self, payload: discord.RawReactionActionEvent, added: bool):
+        key = str(payload.message_id)
+        if payload.emoji.name != "🎉" or payload.user_id == self.bot.user.id:
+            return
+
+        journal = self._entry_journal.get(key)
+        if journal is not None:
+            journal.append((payload.user_id, added))
+        if key not in self.entrants:
+            return
+
+        if added:
+            self.entrants[key].add(payload.user_id)
+        else:
+            self.entrants[key].discard(payload.user_id)
+        self._entrant_changes.setdefault(key, {})[payload.user_id] = added
+
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = self.bot.loop.create_task(self._flush_entrants_later())
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        await self._handle_entry(payload, True)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        await self._handle_entry(payload, False)
 
     @commands.group(
         name="giveaway",
@@ -203,14 +417,11 @@ class GiveawayPlugin(commands.Cog):
         def cancel_check(msg: discord.Message):
             return msg.content == "cancel" or msg.content == f"{ctx.prefix}cancel"
 
-        embed = discord.Embed(colour=0x00FF00)
-
         await ctx.send(embed=self.generate_embed("What is the giveaway item?"))
         giveaway_item = await self.bot.wait_for("message", check=check)
         if cancel_check(giveaway_item) is True:
             await ctx.send("Cancelled.")
             return
-        embed.title = giveaway_item.content
         await ctx.send(
             embed=self.generate_embed("How many winners are to be selected?")
         )
@@ -268,28 +479,24 @@ class GiveawayPlugin(commands.Cog):
         if time_cancel is True:
             return
 
-        embed.description = (
-            f"React with 🎉 to enter the giveaway!\n\n"
-            f"Time Remaining: **{datetime.fromtimestamp(giveaway_time).strftime('%d %H:%M:%S')}**"
-        )
-        embed.set_footer(
-            text=f"{giveaway_winners} {'winners' if giveaway_winners > 1 else 'winner'} | Ends at"
-        )
-        embed.timestamp = datetime.fromtimestamp(giveaway_time)
-        msg: discord.Message = await channel.send(embed=embed)
-        await msg.add_reaction("🎉")
         giveaway_obj = {
             "item": giveaway_item.content,
             "winners": giveaway_winners,
             "time": giveaway_time,
             "guild": ctx.guild.id,
             "channel": channel.id,
-            "message": msg.id,
         }
+        msg: discord.Message = await channel.send(
+            embed=self._giveaway_embed(giveaway_obj)
+        )
+        # track entries before reacting, members can react as soon as the message is sent
+        self.entrants[str(msg.id)] = set()
+        await msg.add_reaction("🎉")
+        giveaway_obj["message"] = msg.id
         self.active_giveaways[str(msg.id)] = giveaway_obj
         await ctx.send("Done!")
-        await self._update_db()
-        await self._start_new_giveaway_thread(giveaway_obj)
+        await self._save_giveaway(giveaway_obj)
+        self._schedule_giveaway(giveaway_obj)
 
     @checks.has_permissions(PermissionLevel.ADMIN)
     @giveaway.command(name="reroll", aliases=["rroll"])
@@ -306,16 +513,6 @@ class GiveawayPlugin(commands.Cog):
             await ctx.send("Sorry, but you can't reroll an active giveaway.")
             return
 
-        async def get_random_user(users, _guild, _winners):
-            rnd = random.choice(users)
-            in_guild = _guild.get_member(rnd)
-            if rnd in _winners or in_guild is None or in_guild.id == self.bot.user.id:
-                idk = await get_random_user(users, _guild, _winners)
-                return idk
-            win = [] + _winners
-            win.append(rnd)
-            return win
-
         try:
             message = await ctx.channel.fetch_message(int(_id))
         except discord.Forbidden:
@@ -331,7 +528,8 @@ class GiveawayPlugin(commands.Cog):
             )
             return
 
-        if len(message.reactions) <= 0:
+        entrants = await self._get_entrants(_id, message)
+        if not entrants:
             embed = message.embeds[0]
             embed.description = f"Giveaway has ended!\n\nSadly no one participated :("
             embed.set_footer(
@@ -340,46 +538,56 @@ class GiveawayPlugin(commands.Cog):
             await message.edit(embed=embed)
             return
 
-        for r in message.reactions:
-            if r.emoji == "🎉":
-                reactions = r
-                reacted_users = await reactions.users().flatten()
-                if len(reacted_users) <= 1:
-                    embed = message.embeds[0]
-                    embed.description = (
-                        f"Giveaway has ended!\n\nSadly no one participated :("
-                    )
-                    await message.edit(embed=embed)
-                    del reacted_users, embed
-                    break
+        winners = self._pick_winners(entrants, ctx.guild, winners_count)
+        if not winners:
+            await ctx.send("None of the participants are in the server anymore.")
+            return
+        winners_count = len(winners)
 
-                # -1 cuz 1 for self
-                if winners_count > (len(reacted_users) - 1):
-                    winners_count = len(reacted_users) - 1
+        embed = message.embeds[0]
+        winners_text = ""
+        for winner in winners:
+            winners_text += f"<@{winner}> "
 
-                winners = []
+        embed.description = f"Giveaway has ended!\n\n**{'Winners' if winners_count > 1 else 'Winner'}:** {winners_text}"
+        embed.set_footer(
+            text=f"{winners_count} {'winners' if winners_count > 1 else 'winner'} | Ended at"
+        )
+        await message.edit(embed=embed)
+        await ctx.channel.send(
+            f"🎉 Congratulations {winners_text}, you have won **{embed.title}**!"
+        )
 
-                for index in range(len(reacted_users)):
-                    reacted_users[index] = reacted_users[index].id
+    @giveaway.command(name="refresh", aliases=["interval"])
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def refresh(self, ctx: commands.Context, seconds: int):
+        """
+        Set how often the time remaining of active giveaways is updated
 
-                for _ in range(winners_count):
-                    winners = await get_random_user(reacted_users, ctx.guild, winners)
+        Use `0` to show a discord timestamp instead, which counts down by itself and needs no edits.
 
-                embed = message.embeds[0]
-                winners_text = ""
-                for winner in winners:
-                    winners_text += f"<@{winner}> "
+        **Usage:**
+        {prefix}giveaway refresh <seconds>
+        """
 
-                embed.description = f"Giveaway has ended!\n\n**{'Winners' if winners_count > 1 else 'Winner'}:** {winners_text}"
-                embed.set_footer(
-                    text=f"{winners_count} {'winners' if winners_count > 1 else 'winner'} | Ended at"
-                )
-                await message.edit(embed=embed)
-                await ctx.channel.send(
-                    f"🎉 Congratulations {winners_text}, you have won **{embed.title}**!"
-                )
-                del winners_text, winners, winners_count, reacted_users, embed
-                break
+        if seconds < 0:
+            await ctx.send("The refresh interval can't be negative.")
+            return
+        if 0 < seconds < 15:
+            await ctx.send("The refresh interval has to be `0` or at least `15` seconds.")
+            return
+
+        self.refresh_interval = seconds
+        await self.db.find_one_and_update(
+            {"_id": "config"},
+            {"$set": {"refresh_interval": seconds}},
+            upsert=True,
+        )
+        # switch the active giveaways over to the new format right away
+        await self._refresh_countdowns()
+        self._wakeup.set()
+        await ctx.send("Done!")
+        return
 
     @giveaway.command(name="cancel", aliases=["stop"])
     @checks.has_permissions(PermissionLevel.ADMIN)
@@ -415,13 +623,22 @@ class GiveawayPlugin(commands.Cog):
         embed = message.embeds[0]
         embed.description = "The giveaway has been cancelled."
         await message.edit(embed=embed)
-        self.active_giveaways.pop(_id)
-        await self._update_db()
+        self.entrants.pop(_id, None)
+        self._entrant_changes.pop(_id, None)
+        await self._remove_giveaway(_id)
         await ctx.send("Cancelled!")
         return
 
-    async def _start_new_giveaway_thread(self, obj):
-        await self.bot.loop.create_task(self._handle_giveaway(obj))
+    def _pick_winners(self, user_ids, guild: discord.Guild, count: int) -> typing.List[int]:
+        """
+        Pick up to `count` distinct winners from the entrants that are still in the guild
+        """
+        eligible = [
+            user_id
+            for user_id in set(user_ids)
+            if user_id != self.bot.user.id and guild.get_member(user_id) is not None
+        ]
+        return random.sample(eligible, min(count, len(eligible)))
 
     def generate_embed(self, description: str):
         embed = discord.Embed()
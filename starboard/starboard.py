@@ -1,4 +1,6 @@
+import asyncio
 import typing
+from collections import OrderedDict
 from datetime import datetime
 
 import discord
@@ -20,10 +22,52 @@ class Starboard(commands.Cog):
         self.db = bot.plugin_db.get_partition(self)
         self.channel = None
         self.stars = 2
-        self.user_blacklist: list = list()
-        self.channel_blacklist: list = list()
+        self.user_blacklist: typing.Set[str] = set()
+        self.channel_blacklist: typing.Set[str] = set()
+        # source message id -> starboard message id, most recently used last
+        self._entries: "OrderedDict[int, int]" = OrderedDict()
+        self._entries_cache_size = 1000
+        # source message id -> {"stars", "author", "author_starred"}, kept up to date from reaction deltas
+        self._tallies: "OrderedDict[int, dict]" = OrderedDict()
+        # deltas received while a message's tally wasn't cached yet, applied once it's loaded
+        self._pending_deltas: typing.Dict[int, typing.List[typing.Tuple[int, bool]]] = dict()
+        # reactions on the same message within this many seconds are coalesced into one update
+        self._update_delay = 2
+        self._pending_updates: typing.Dict[int, asyncio.Task] = dict()
+        self._dirty_messages: typing.Set[int] = set()
+        # messages whose reactions were cleared, their next update recounts instead of using the tally
+        self._stale: typing.Set[int] = set()
         self.bot.loop.create_task(self._set_val())
 
+    def cog_unload(self):
+        for task in self._pending_updates.values():
+            task.cancel()
+        # the cancelled updates already applied their reactions to the cached tallies
+        self.bot.loop.create_task(
+            self._save_pending(list(self._pending_updates), set(self._pending_deltas) | self._stale)
+        )
+
+    async def _save_pending(self, message_ids: typing.List[int], stale_ids: typing.Set[int]):
+        for message_id in message_ids:
+            tally = self._tallies.get(message_id)
+            if tally is not None and message_id not in stale_ids:
+                await self._save_tally(message_id, tally)
+        if stale_ids:
+            await self._mark_stale(stale_ids)
+
+    def _session(self) -> typing.Optional[str]:
+        # changes whenever the bot reconnects without resuming, i.e. whenever reactions could have been missed
+        return getattr(self.bot.ws, "session_id", None)
+
+    async def _mark_stale(self, source_ids: typing.Iterable[int]):
+        """
+        Make the next load of these tallies recount them from the message
+        """
+        await self.db.update_many(
+            {"_id": {"$in": [str(source_id) for source_id in source_ids]}},
+            {"$unset": {"session": ""}},
+        )
+
     async def _update_db(self):
         await self.db.find_one_and_update(
             {"_id": "config"},
@@ -32,8 +76,8 @@ class Starboard(commands.Cog):
                     "channel": self.channel,
                     "stars": self.stars,
                     "blacklist": {
-                        "user": self.user_blacklist,
-                        "channel": self.channel_blacklist,
+                        "user": list(self.user_blacklist),
+                        "channel": list(self.channel_blacklist),
                     },
                 }
             },
@@ -49,8 +93,132 @@ class Starboard(commands.Cog):
 
         self.channel = config.get("channel", None)
         self.stars = config.get("stars", 2)
-        self.user_blacklist = config["blacklist"]["user"]
-        self.channel_blacklist = config["blacklist"]["channel"]
+        self.user_blacklist = set(config["blacklist"]["user"])
+        self.channel_blacklist = set(config["blacklist"]["channel"])
+
+    def _cache_entry(self, source_id: int, starboard_id: int):
+        self._entries[source_id] = starboard_id
+        self._entries.move_to_end(source_id)
+        while len(self._entries) > self._entries_cache_size:
+            self._entries.popitem(last=False)
+
+    def _cache_tally(self, source_id: int, tally: dict):
+        self._tallies[source_id] = tally
+        self._tallies.move_to_end(source_id)
+        while len(self._tallies) > self._entries_cache_size:
+            # never evict a tally that a queued update is about to persist
+            stale = next((k for k in self._tallies if k not in self._pending_updates), None)
+            if stale is None:
+                break
+            self._tallies.pop(stale)
+
+    async def _load_document(self, source_id: int) -> typing.Optional[dict]:
+        doc = await self.db.find_one({"_id": str(source_id)})
+        if doc is None:
+            return None
+
+        if "starboard" in doc:
+            self._cache_entry(source_id, int(doc["starboard"]))
+        # tallies saved in an earlier session may have missed reactions, those are recounted
+        session = self._session()
+        if "stars" in doc and session is not None and doc.get("session") == session:
+            tally = {
+                "stars": doc["stars"],
+                "author": int(doc["author"]),
+                "author_starred": doc.get("author_starred", False),
+            }
+            for user_id, added in self._pending_deltas.pop(source_id, []):
+                self._apply_delta(tally, user_id, added)
+            self._cache_tally(source_id, tally)
+        return doc
+
+    async def _get_entry(self, source_id: int) -> typing.Optional[int]:
+        if source_id in self._entries:
+            self._entries.move_to_end(source_id)
+            return self._entries[source_id]
+
+        await self._load_document(source_id)
+        return self._entries.get(source_id)
+
+    async def _get_tally(self, source_id: int) -> typing.Optional[dict]:
+        if source_id in self._tallies:
+            self._tallies.move_to_end(source_id)
+            return self._tallies[source_id]
+
+        await self._load_document(source_id)
+        return self._tallies.get(source_id)
+
+    @staticmethod
+    def _apply_delta(tally: dict, user_id: int, added: bool):
+        if user_id == tally["author"]:
+            tally["author_starred"] = added
+        else:
+            tally["stars"] = max(0, tally["stars"] + (1 if added else -1))
+
+    async def _recount(self, message: discord.Message) -> dict:
+        """
+        Count the stars of a message from scratch, only used when there is no usable tally
+        """
+        tally = {"stars": 0, "author": message.author.id, "author_starred": False}
+
+        star_reaction: typing.Optional[discord.Reaction] = discord.utils.find(
+            lambda r: r.emoji == "⭐", message.reactions
+        )
+        if star_reaction is not None:
+            reacted_users: typing.List[discord.User] = await star_reaction.users().flatten()
+            for user in reacted_users:
+                if user.id == message.author.id:
+                    tally["author_starred"] = True
+                elif str(user.id) not in self.user_blacklist:
+                    tally["stars"] += 1
+
+        # anything that arrived while paging through the users is already part of the recount
+        self._pending_deltas.pop(message.id, None)
+        self._cache_tally(message.id, tally)
+        return tally
+
+    async def _save_tally(self, source_id: int, tally: dict):
+        await self.db.find_one_and_update(
+            {"_id": str(source_id)},
+            {
+                "$set": {
+                    "stars": tally["stars"],
+                    "author": str(tally["author"]),
+                    "author_starred": tally["author_starred"],
+                    "session": self._session(),
+                }
+            },
+            upsert=True,
+        )
+
+    async def _set_entry(self, source_id: int, starboard_id: int):
+        self._cache_entry(source_id, starboard_id)
+        await self.db.find_one_and_update(
+            {"_id": str(source_id)},
+            {"$set": {"starboard": str(starboard_id)}},
+            upsert=True,
+        )
+
+    async def _delete_entry(self, source_id: int):
+        self._entries.pop(source_id, None)
+        # the tally lives in the same document, so only drop the starboard message
+        await self.db.find_one_and_update(
+            {"_id": str(source_id)}, {"$unset": {"starboard": ""}}
+        )
+
+    async def _fetch_entry_message(
+            self, starboard_channel: discord.TextChannel, source_id: int
+    ) -> typing.Optional[discord.Message]:
+        starboard_id = await self._get_entry(source_id)
+        if starboard_id is None:
+            return None
+
+        try:
+            return await starboard_channel.fetch_message(starboard_id)
+        except discord.NotFound:
+            logger.info("Starboard message was deleted, dropping index entry")
+            await self._delete_entry(source_id)
+            return None
 
     @commands.group(aliases=["st", "sb"], invoke_without_command=True)
     @checks.has_permissions(PermissionLevel.ADMIN)
@@ -104,14 +272,15 @@ class Starboard(commands.Cog):
         """
 
         if str(member.id) in self.user_blacklist:
-            self.user_blacklist.remove(str(member.id))
+            self.user_blacklist.discard(str(member.id))
             removed = True
         else:
-            self.user_blacklist.append(str(member.id))
+            self.user_blacklist.add(str(member.id))
             removed = False
+        await self._update_db()
 
         await ctx.send(
-            f"{'Un' if removed else None}Blacklisted **{member.name}#{member.discriminator}**"
+            f"{'Un' if removed else ''}Blacklisted **{member.name}#{member.discriminator}**"
         )
         return
 
@@ -126,146 +295,221 @@ class Starboard(commands.Cog):
         starboard blacklist channel **#channel**
         """
         if str(channel.id) in self.channel_blacklist:
-            self.channel_blacklist.remove(str(channel.id))
-            await self._update_db()
+            self.channel_blacklist.discard(str(channel.id))
             removed = True
         else:
-            self.channel_blacklist.append(str(channel.id))
-            await self._update_db()
+            self.channel_blacklist.add(str(channel.id))
             removed = False
+        await self._update_db()
 
-        await ctx.send(f"{'Un' if removed else None}Blacklisted {channel.mention}")
+        await ctx.send(f"{'Un' if removed else ''}Blacklisted {channel.mention}")
         return
 
+    @starboard.command(aliases=["reindex"])
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def migrate(self, ctx: commands.Context):
+        """
+        Rebuild the starboard index from the footers of existing starboard messages
+        Only needs to be run once after updating the plugin
+        **Usage:**
+        starboard migrate
+        """
+        if not self.channel:
+            await ctx.send("No starboard channel has been set.")
+            return
+
+        starboard_channel: discord.TextChannel = self.bot.get_channel(int(self.channel))
+        if starboard_channel is None:
+            await ctx.send("Couldn't find the starboard channel.")
+            return
+
+        indexed = 0
+        async with ctx.typing():
+            async for msg in starboard_channel.history(limit=None):
+                if msg.author.id != self.bot.user.id or len(msg.embeds) <= 0:
+                    continue
+
+                footer = msg.embeds[0].footer
+                if not footer or not footer.text or "⭐" not in footer.text:
+                    continue
+
+                source_id = footer.text.rsplit("|", 1)[-1].strip()
+                if not source_id.isdigit():
+                    continue
+
+                await self._set_entry(int(source_id), msg.id)
+                indexed += 1
+
+        await ctx.send(f"Done! Indexed `{indexed}` starboard messages.")
+
+    @starboard.command()
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def resync(self, ctx: commands.Context, message: discord.Message):
+        """
+        Recount the stars of a message from its reactions and update its starboard entry
+        **Usage:**
+        starboard resync **message link or id**
+        """
+        await self._update_entry(message.channel.id, message.id, recount=True)
+        await ctx.send(f"Done! Resynced the stars of `{message.id}`.")
+
     @commands.Cog.listener()
     async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
         await self.handle_reaction(payload=payload)
 
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear(self, payload: discord.RawReactionClearEvent):
+        await self.handle_clear(payload.guild_id, payload.channel_id, payload.message_id)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear_emoji(self, payload: discord.RawReactionClearEmojiEvent):
+        if payload.emoji.name == "⭐":
+            await self.handle_clear(payload.guild_id, payload.channel_id, payload.message_id)
+
+    async def handle_clear(self, guild_id: typing.Optional[int], channel_id: int, message_id: int):
+        if not self.channel or guild_id is None or guild_id != int(self.bot.config["guild_id"]):
+            return
+
+        # messages that were never starred have nothing to clear
+        if message_id not in self._tallies and await self._load_document(message_id) is None:
+            return
+
+        self._tallies.pop(message_id, None)
+        self._pending_deltas.pop(message_id, None)
+        self._stale.add(message_id)
+        self._schedule_update(channel_id, message_id)
+
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
         await self.handle_reaction(payload=payload)
 
     async def handle_reaction(self, payload: discord.RawReactionActionEvent):
-        config = await self.db.find_one({"_id": "config"})
+        if payload.emoji.name != "⭐":
+            return
 
-        if not config or not self.channel:
-            logger.info("No config or channel")
+        # the cached attributes are the source of truth, they're kept in sync by the config commands
+        if not self.channel:
+            logger.info("No channel")
+            return
+
+        # stars outside the configured guild (e.g. the modmail server) are never counted
+        if payload.guild_id is None or payload.guild_id != int(self.bot.config["guild_id"]):
             return
 
         # check for blacklist
-        if self.channel_blacklist.__contains__(str(payload.channel_id)) or self.user_blacklist.__contains__(
-                str(payload.user_id)):
+        if str(payload.channel_id) in self.channel_blacklist or str(payload.user_id) in self.user_blacklist:
             logger.info("Blacklisted")
             return
 
+        added = payload.event_type == "REACTION_ADD"
+        if payload.message_id in self._tallies:
+            self._apply_delta(self._tallies[payload.message_id], payload.user_id, added)
+        else:
+            self._pending_deltas.setdefault(payload.message_id, []).append((payload.user_id, added))
+
+        self._schedule_update(payload.channel_id, payload.message_id)
+
+    def _schedule_update(self, channel_id: int, message_id: int):
+        # an update for this message is already queued or running, make sure it recounts once more
+        if message_id in self._pending_updates:
+            self._dirty_messages.add(message_id)
+            return
+
+        self._pending_updates[message_id] = self.bot.loop.create_task(
+            self._process_updates(channel_id, message_id)
+        )
+
+    async def _process_updates(self, channel_id: int, message_id: int):
+        try:
+            while True:
+                await asyncio.sleep(self._update_delay)
+                self._dirty_messages.discard(message_id)
+                try:
+                    await self._update_entry(channel_id, message_id)
+                except discord.HTTPException:
+                    logger.error("Failed to update the starboard entry", exc_info=True)
+                    break
+                if message_id not in self._dirty_messages:
+                    break
+        finally:
+            self._pending_updates.pop(message_id, None)
+            self._dirty_messages.discard(message_id)
+            # deltas are only kept for a load in progress, the next load recounts anyway
+            self._pending_deltas.pop(message_id, None)
+            if message_id in self._stale:
+                # the recount didn't happen, keep the stored tally from being trusted
+                self._stale.discard(message_id)
+                await self._mark_stale([message_id])
+
+    async def _update_entry(self, channel_id: int, message_id: int, recount: bool = False):
+        if not self.channel:
+            return
+
         guild: discord.Guild = self.bot.get_guild(int(self.bot.config["guild_id"]))
         starboard_channel: discord.TextChannel = guild.get_channel(int(self.channel))
-        channel: discord.TextChannel = guild.get_channel(payload.channel_id)
-        user: discord.User = await self.bot.fetch_user(payload.user_id)
+        channel: discord.TextChannel = guild.get_channel(channel_id)
 
         if not channel or not starboard_channel:
             logger.info("No channel found")
             return
 
-        message: discord.Message = await channel.fetch_message(payload.message_id)
-
-        if message.author.id == payload.user_id:
-            logger.info("Author added the reaction")
+        message: typing.Optional[discord.Message] = None
+        stale = message_id in self._stale
+        self._stale.discard(message_id)
+        try:
+            tally = None if recount or stale else await self._get_tally(message_id)
+            if tally is None:
+                message = await channel.fetch_message(message_id)
+                tally = await self._recount(message)
+            await self._save_tally(message_id, tally)
+        except Exception:
+            if stale:
+                self._stale.add(message_id)
+            raise
+
+        count = tally["stars"]
+        entry_message = await self._fetch_entry_message(starboard_channel, message_id)
+
+        if count < self.stars:
+            if entry_message is not None:
+                logger.info("delete message")
+                await entry_message.delete()
+                await self._delete_entry(message_id)
             return
 
-        found_emote = False
-        for emote in message.reactions:
-            if emote.emoji == "⭐":
-                found_emote = True
-                reaction: discord.Reaction = emote
-                count = reaction.count
-                reacted_users: typing.List[discord.User] = await reaction.users().flatten()
-                has_author_reacted = discord.utils.find(lambda u: u.id == message.author.id, reacted_users)
-                if has_author_reacted:
-                    count = count - 1
-
-                should_delete = False
-
-                if count < self.stars:
-                    should_delete = True
-
-                messages = await starboard_channel.history(
-                    limit=70,
-                    around=message.created_at
-                ).flatten()
-                found = False
-
-                for msg in messages:
-                    if len(msg.embeds) <= 0:
-                        logger.info("No embeds")
-                        continue
-
-                    if not msg.embeds[0].footer or not msg.embeds[0].footer.text or "⭐" not in msg.embeds[
-                        0].footer.text:
-                        print(msg.embeds)
-                        logger.info("No stars")
-                        continue
-
-                    if msg.embeds[0].footer.text.endswith(str(payload.message_id)):
-                        logger.info("got one")
-                        found = True
-                        if should_delete:
-                            logger.info("delete message")
-                            await msg.delete()
-                            break
-                        e = msg.embeds[0]
-                        e.set_footer(text=f"⭐ {count} | {payload.message_id}")
-                        await msg.edit(content=f"<#{payload.channel_id}>", embed=e)
-                        break
-
-                if not found:
-                    if should_delete:
-                        logger.info("Should Delete")
-                        return
-
-                    embed = discord.Embed(
-                        color=discord.Colour.gold(),
-                        description=message.content,
-                        timestamp=datetime.utcnow(),
-                        title="Jump to message ►",
-                        url=message.jump_url
-                    )
-                    embed.set_author(
-                        name=str(message.author),
-                        icon_url=message.author.avatar_url,
-                    )
-                    embed.set_footer(text=f"⭐ {count} | {payload.message_id}")
-                    if len(message.attachments) > 1:
-                        try:
-                            embed.set_image(url=message.attachments[0].url)
-                        except:
-                            pass
-
-                    await starboard_channel.send(
-                        f"{channel.mention}", embed=embed
-                    )
-
-        if not found_emote:
-            messages = await starboard_channel.history(
-                limit=70,
-                around=message.created_at
-            ).flatten()
-            found = False
-
-            for msg in messages:
-                if len(msg.embeds) <= 0:
-                    logger.info("No embeds")
-                    continue
+        if entry_message is not None:
+            e = entry_message.embeds[0]
+            footer = f"⭐ {count} | {message_id}"
+            if e.footer.text != footer:
+                e.set_footer(text=footer)
+                await entry_message.edit(content=f"<#{channel_id}>", embed=e)
+            return
 
-                if not msg.embeds[0].footer or not msg.embeds[0].footer.text or "⭐" not in msg.embeds[0].footer.text:
-                    print(msg.embeds)
-                    logger.info("No stars")
-                    continue
+        if message is None:
+            message = await channel.fetch_message(message_id)
 
-                if msg.embeds[0].footer.text.endswith(str(payload.message_id)):
-                    logger.info("got one")
-                    found = True
-                    await msg.delete()
+        embed = discord.Embed(
+            color=discord.Colour.gold(),
+            description=message.content,
+            timestamp=datetime.utcnow(),
+            title="Jump to message ►",
+            url=message.jump_url
+        )
+        embed.set_author(
+            name=str(message.author),
+            icon_url=message.author.avatar_url,
+        )
+        embed.set_footer(text=f"⭐ {count} | {message_id}")
+        if len(message.attachments) > 1:
+            try:
+                embed.set_image(url=message.attachments[0].url)
+            except:
+                pass
+
+        entry_message = await starboard_channel.send(
+            f"{channel.mention}", embed=embed
+        )
+        await self._set_entry(message_id, entry_message.id)
 
 
 def setup(bot):
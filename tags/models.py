@@ -1,10 +1,22 @@
-from typing import Any, Callable
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 
+import heapq
+import itertools
+import json
+import math
 import string
 
 import discord
 from discord.ext import commands
 
+_formatter = string.Formatter()
+
+# literal text, field name, conversion, format spec, the field as it was written
+FormatPiece = Tuple[str, Optional[str], Optional[str], str, str]
+
+TAG_VARIABLES = ("member", "guild", "bot")
+
 
 class SafeFormat(object):
     def __init__(self, **kw):
@@ -22,10 +34,254 @@ class SafeString(str):
             return SafeString('%s.%s}' % (self[:-1], name))
 
 
+def is_variable(field_name: str, names: Tuple[str, ...] = TAG_VARIABLES) -> bool:
+    """
+    For security reasons only `variable` or `variable.attribute` is allowed
+    Internals and indexing are never looked up
+    """
+    parts = field_name.split(".")
+    return (
+        parts[0] in names
+        and len(parts) <= 2
+        and all(part and not part.startswith("_") and "[" not in part for part in parts)
+    )
+
+
+def compile_format(
+    text: str, names: Tuple[str, ...] = TAG_VARIABLES
+) -> Union[str, List[FormatPiece]]:
+    """
+    Split a format string into its pieces once,
+    strings without any variables are returned exactly as they were written
+    """
+    try:
+        parsed = list(_formatter.parse(text))
+    except ValueError:
+        return text
+
+    pieces = []
+    for literal, field_name, format_spec, conversion in parsed:
+        if field_name is None:
+            pieces.append((literal, None, None, "", ""))
+            continue
+        # positional and nested fields can't be filled by name, leave them untouched
+        if not field_name or field_name[0].isdigit() or "{" in (format_spec or ""):
+            return text
+        raw = "{%s%s%s}" % (
+            field_name,
+            f"!{conversion}" if conversion else "",
+            f":{format_spec}" if format_spec else "",
+        )
+        if not is_variable(field_name, names):
+            pieces.append((literal + raw, None, None, "", ""))
+            continue
+        pieces.append((literal, field_name, conversion, format_spec or "", raw))
+
+    if all(field_name is None for _, field_name, _, _, _ in pieces):
+        return text
+    return pieces
+
+
+def render_format(compiled: Union[str, List[FormatPiece]], variables: SafeFormat) -> str:
+    if isinstance(compiled, str):
+        return compiled
+
+    out = []
+    for literal, field_name, conversion, format_spec, raw in compiled:
+        out.append(literal)
+        if field_name is None:
+            continue
+        try:
+            value, _ = _formatter.get_field(field_name, (), variables)
+            value = _formatter.convert_field(value, conversion)
+            out.append(_formatter.format_field(value, format_spec))
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+            out.append(raw)
+    return "".join(out)
+
+
+def _compile_value(value: Any) -> Any:
+    if isinstance(value, str):
+        return compile_format(value)
+    if isinstance(value, dict):
+        return {k: _compile_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_compile_value(v) for v in value]
+    return value
+
+
+def _render_value(value: Any, variables: SafeFormat) -> Any:
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        return {k: _render_value(v, variables) for k, v in value.items()}
+    if isinstance(value, list):
+        # a compiled format string is a list of tuples
+        if value and isinstance(value[0], tuple):
+            return render_format(value, variables)
+        return [_render_value(v, variables) for v in value]
+    return value
+
+
+class TagTemplate(object):
+    """
+    A tag's content parsed once when the tag is created or edited,
+    rendering it only substitutes the variables
+    """
+
+    def __init__(self, content: str):
+        self.source = content
+        self.content = None
+        self.embed = None
+        # embeds without any variables are built once and reused
+        self._static_embed: Optional[discord.Embed] = None
+
+        try:
+            data = json.loads(content)
+        except (json.JSONDecodeError, TypeError):
+            data = None
+
+        if isinstance(data, dict) and isinstance(data.get("embed"), dict):
+            try:
+                # checked once here, an invalid embed is sent as the text it was written as
+                static_embed = discord.Embed.from_dict(data["embed"])
+            except Exception:
+                data = None
+        if isinstance(data, dict) and isinstance(data.get("embed"), dict):
+            if isinstance(data.get("content"), str):
+                self.content = compile_format(data["content"])
+            self.embed = _compile_value(data["embed"])
+            if self.embed == data["embed"]:
+                self._static_embed = static_embed
+        else:
+            self.content = compile_format(content)
+
+    def render(self, **variables) -> Dict[str, Any]:
+        """
+        Returns the keyword arguments to send the tag with
+        """
+        safe = SafeFormat(**variables)
+        kwargs = {}
+        if self.content is not None:
+            kwargs["content"] = render_format(self.content, safe)
+        if self._static_embed is not None:
+            kwargs["embed"] = self._static_embed
+        elif self.embed is not None:
+            try:
+                kwargs["embed"] = discord.Embed.from_dict(_render_value(self.embed, safe))
+            except Exception:
+                return {"content": self.source}
+        return kwargs
+
+
 def apply_vars(self, member, message, invite):
-    return string.Formatter().vformat(message, [], SafeFormat(
+    return render_format(compile_format(message, TAG_VARIABLES + ("invite",)), SafeFormat(
         member=member,
         guild=member.guild,
         bot=self.bot.user,
         invite=invite
     ))
+
+
+class TrigramIndex(object):
+    """
+    Fuzzy name lookup, kept up to date as names are added and removed
+    """
+
+    def __init__(self):
+        # trigram -> number of trigrams of the name -> names, so only similarly sized names are scored
+        self._postings: Dict[str, Dict[int, Set[str]]] = defaultdict(lambda: defaultdict(set))
+        self._grams: Dict[str, Set[str]] = {}
+        # number of names with each trigram
+        self._frequency: Counter = Counter()
+        # number of trigrams -> number of names with that many
+        self._sizes: Counter = Counter()
+        # names scored first to raise the score the rest has to beat
+        self.seed_size = 32
+
+    @staticmethod
+    def trigrams(name: str) -> Set[str]:
+        padded = f"  {name.lower()} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add(self, name: str):
+        if name in self._grams:
+            return
+        grams = self.trigrams(name)
+        self._grams[name] = grams
+        self._sizes[len(grams)] += 1
+        self._frequency.update(grams)
+        for gram in grams:
+            self._postings[gram][len(grams)].add(name)
+
+    def remove(self, name: str):
+        grams = self._grams.pop(name, None)
+        if grams is None:
+            return
+        size = len(grams)
+        self._sizes[size] -= 1
+        if not self._sizes[size]:
+            del self._sizes[size]
+        self._frequency.subtract(grams)
+        for gram in grams:
+            if not self._frequency[gram]:
+                del self._frequency[gram]
+            by_size = self._postings[gram]
+            by_size[size].discard(name)
+            if not by_size[size]:
+                del by_size[size]
+            if not by_size:
+                del self._postings[gram]
+
+    def search(self, query: str, limit: int = 3, threshold: float = 0.3) -> List[str]:
+        grams = self.trigrams(query)
+        q = len(grams)
+        postings = {gram: self._postings[gram] for gram in grams if gram in self._postings}
+        # a name with n trigrams scores at most min(q, n) / max(q, n), the most similar sizes go first
+        sizes = sorted(self._sizes, key=lambda n: min(q, n) / max(q, n), reverse=True)
+        # min-heap of the best (score, name) so far
+        best: List[Tuple[float, str]] = []
+        scored: Set[str] = set()
+
+        def score(names: Set[str]):
+            names = names - scored
+            scored.update(names)
+            for name in names:
+                other = self._grams[name]
+                shared = len(grams & other)
+                value = shared / (q + len(other) - shared)
+                if value < threshold:
+                    continue
+                if len(best) < limit:
+                    heapq.heappush(best, (value, name))
+                elif (value, name) > best[0]:
+                    heapq.heapreplace(best, (value, name))
+
+        # names with the rarest trigrams of the query are likely matches, scoring a few of them
+        # first raises the floor so the pass below only has to look at a handful of names
+        seeds = set()
+        for gram in sorted(postings, key=self._frequency.__getitem__):
+            for n in sizes:
+                seeds.update(itertools.islice(postings[gram].get(n, ()), self.seed_size - len(seeds)))
+                if len(seeds) >= self.seed_size:
+                    break
+            if len(seeds) >= self.seed_size:
+                break
+        score(seeds)
+
+        for n in sizes:
+            floor = best[0][0] if len(best) >= limit else threshold
+            # the closest sizes come first, past this one no name can beat the floor
+            if min(q, n) / max(q, n) < floor:
+                break
+
+            lists = [by_size[n] for by_size in postings.values() if n in by_size]
+            # scoring at least the floor takes this many shared trigrams: s / (q + n - s) >= floor
+            needed = max(1, math.ceil(floor * (q + n) / (1 + floor) - 1e-9))
+            if len(lists) < needed:
+                continue
+            # a name sharing `needed` of them is in one of the rarest len(lists) - needed + 1 lists
+            lists.sort(key=len)
+            score(set().union(*lists[:len(lists) - needed + 1]))
+
+        return [name for _, name in sorted(best, reverse=True)]
@@ -1,20 +1,106 @@
+import asyncio
 import json
+import math
+from collections import Counter
 from typing import Any, Dict, Union
 
 import discord
 from datetime import datetime
 from discord.ext import commands
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
 
 from core import checks
-from core.models import PermissionLevel
-from .models import apply_vars, SafeString
+from core.models import PermissionLevel, getLogger
+from .models import apply_vars, SafeString, TagTemplate, TrigramIndex
+
+logger = getLogger(__name__)
 
 
 class TagsPlugin(commands.Cog):
     def __init__(self, bot):
         self.bot: discord.Client = bot
         self.db = bot.plugin_db.get_partition(self)
-        
+        # name -> tag document, the source of truth for lookups and kept in sync on every write
+        self.tags: Dict[str, Dict[str, Any]] = {}
+        # name -> compiled content, rebuilt whenever a tag is created or edited
+        self.templates: Dict[str, TagTemplate] = {}
+        self.names = TrigramIndex()
+        self._loaded = asyncio.Event()
+        # False if the tags couldn't be loaded, lookups then go to the database
+        self._cached = False
+        # uses that haven't been written to the database yet
+        self._pending_uses: Counter = Counter()
+        self.uses_flush_interval = 60
+        self.list_page_size = 25
+        self.bot.loop.create_task(self._load_tags())
+        self._flush_task = self.bot.loop.create_task(self._flush_uses_loop())
+
+    def cog_unload(self):
+        self._flush_task.cancel()
+        self.bot.loop.create_task(self._flush_uses())
+
+    async def _load_tags(self):
+        # the partition belongs to this bot, and with it its guild, so names only have to be unique in here
+        try:
+            await self.db.create_index(
+                "name",
+                unique=True,
+                partialFilterExpression={"name": {"$exists": True}},
+            )
+        except OperationFailure:
+            logger.error("Couldn't create the unique index on tag names, remove the duplicate tags first.")
+        try:
+            # back the sort orders of the tag list
+            await self.db.create_index("uses")
+            await self.db.create_index("updatedAt")
+        except PyMongoError:
+            logger.error("Couldn't create the indexes for the tag list.", exc_info=True)
+
+        try:
+            async for tag in self.db.find({"name": {"$exists": True}}):
+                self.tags[tag["name"]] = tag
+                self.templates[tag["name"]] = TagTemplate(tag["content"])
+                self.names.add(tag["name"])
+            self._cached = True
+        except PyMongoError:
+            logger.error("Couldn't load the tags, looking them up in the database instead.", exc_info=True)
+        finally:
+            # lookups wait on this, it has to be set even if loading failed
+            self._loaded.set()
+
+    async def _flush_uses_loop(self):
+        while True:
+            await asyncio.sleep(self.uses_flush_interval)
+            try:
+                await self._flush_uses()
+            except PyMongoError:
+                logger.error("Couldn't save the tag uses, retrying with the next flush.", exc_info=True)
+
+    async def _flush_uses(self):
+        if not self._pending_uses:
+            return
+
+        # swapped out so uses recorded while writing go to the next flush
+        pending, self._pending_uses = self._pending_uses, Counter()
+        names = list(pending)
+        requests = [UpdateOne({"name": name}, {"$inc": {"uses": pending[name]}}) for name in names]
+        try:
+            await self.db.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            # the other increments were applied, only merge back the ones that failed
+            for error in e.details.get("writeErrors", []):
+                name = names[error["index"]]
+                self._pending_uses[name] += pending[name]
+            raise
+        except PyMongoError:
+            self._pending_uses.update(pending)
+            raise
+
+    def _record_use(self, tag: Dict[str, Any]):
+        tag["uses"] += 1
+        self._pending_uses[tag["name"]] += 1
+
     @commands.group(invoke_without_command=True)
     @commands.guild_only()
     @checks.has_permissions(PermissionLevel.REGULAR)
@@ -32,46 +118,74 @@ class TagsPlugin(commands.Cog):
         if (await self.find_db(name=name)) is not None:
             await ctx.send(f":x: | Tag with name `{name}` already exists!")
             return
-        else:
-            ctx.message.content = content
-            await self.db.insert_one(
-                {
-                    "name": name,
-                    "content": ctx.message.clean_content,
-                    "createdAt": datetime.utcnow(),
-                    "updatedAt": datetime.utcnow(),
-                    "author": ctx.author.id,
-                    "uses": 0,
-                }
-            )
 
-            await ctx.send(
-                f":white_check_mark: | Tag with name `{name}` has been successfully created!"
-            )
+        ctx.message.content = content
+        tag = {
+            "name": name,
+            "content": ctx.message.clean_content,
+            "createdAt": datetime.utcnow(),
+            "updatedAt": datetime.utcnow(),
+            "author": ctx.author.id,
+            "uses": 0,
+        }
+        template = TagTemplate(tag["content"])
+        # the unique index on name makes this a single, race free round trip
+        try:
+            await self.db.insert_one(tag)
+        except DuplicateKeyError:
+            await ctx.send(f":x: | Tag with name `{name}` already exists!")
             return
-        
+
+        self.tags[name] = tag
+        self.templates[name] = template
+        self.names.add(name)
+
+        await ctx.send(
+            f":white_check_mark: | Tag with name `{name}` has been successfully created!"
+        )
+        return
+
     @tags.command(name='list')
-    async def list_(self, ctx):
-        '''Get a list of tags that hace already been made.'''
+    async def list_(self, ctx, sort: str = "name", page: int = 1):
+        '''Get a list of tags that hace already been made.
 
-        tags = await self.db.find({}).to_list(length=None)
+        Tags can be sorted by `name`, `uses` or `recent`.'''
 
-        if tags is None:
-            return await ctx.send(':x: | You don\'t have any tags.')
-        
-        list_tags = []
+        sorts = {"name": ("name", 1), "uses": ("uses", -1), "recent": ("updatedAt", -1)}
+        if sort not in sorts:
+            return await ctx.send(f":x: | Can't sort by `{sort}`, use `name`, `uses` or `recent`.")
 
-        for tag in tags:
+        if sort == "uses":
             try:
-                list_tags.append(tag['name'])
-            except:
-                continue
+                await self._flush_uses()
+            except PyMongoError:
+                logger.error("Couldn't save the tag uses before listing them.", exc_info=True)
 
-        send_tags = 'Tags: ' + ', '.join(list_tags)
+        query = {"name": {"$exists": True}}
+        total = await self.db.count_documents(query)
+        if total == 0:
+            return await ctx.send(':x: | You don\'t have any tags.')
 
-        await ctx.send(send_tags)   
+        pages = math.ceil(total / self.list_page_size)
+        page = min(max(page, 1), pages)
 
+        # only the fields shown are fetched and only one page is held at a time
+        cursor = (
+            self.db.find(query, {"_id": 0, "name": 1, "uses": 1})
+            .sort(*sorts[sort])
+            .skip((page - 1) * self.list_page_size)
+            .limit(self.list_page_size)
+        )
+        lines = []
+        async for tag in cursor:
+            lines.append(f"`{tag['name']}` - {tag.get('uses', 0)} uses")
 
+        embed = discord.Embed()
+        embed.colour = discord.Colour.green()
+        embed.title = f"Tags ({total})"
+        embed.description = "\n".join(lines)
+        embed.set_footer(text=f"Page {page}/{pages}")
+        await ctx.send(embed=embed)
 
     @tags.command()
     async def edit(self, ctx: commands.Context, name: str, *, content: str):
@@ -87,10 +201,14 @@ class TagsPlugin(commands.Cog):
         else:
             member: discord.Member = ctx.author
             if ctx.author.id == tag["author"] or member.guild_permissions.manage_guild:
+                template = TagTemplate(content)
+                updated_at = datetime.utcnow()
                 await self.db.find_one_and_update(
                     {"name": name},
-                    {"$set": {"content": content, "updatedAt": datetime.utcnow()}},
+                    {"$set": {"content": content, "updatedAt": updated_at}},
                 )
+                tag.update(content=content, updatedAt=updated_at)
+                self.templates[name] = template
 
                 await ctx.send(
                     f":white_check_mark: | Tag `{name}` is updated successfully!"
@@ -113,6 +231,10 @@ class TagsPlugin(commands.Cog):
                 or ctx.author.guild_permissions.manage_guild
             ):
                 await self.db.delete_one({"name": name})
+                self.tags.pop(name, None)
+                self.templates.pop(name, None)
+                self.names.remove(name)
+                self._pending_uses.pop(name, None)
 
                 await ctx.send(
                     f":white_check_mark: | Tag `{name}` has been deleted successfully!"
@@ -130,17 +252,19 @@ class TagsPlugin(commands.Cog):
         if tag is None:
             await ctx.send(":x: | Tag `{name}` not found.")
         else:
-            member = await ctx.guild.get_member(tag["author"])
+            member = ctx.guild.get_member(tag["author"])
             if member is not None:
                 await ctx.send(
                     f":x: | The owner of the tag is still in the server `{member.name}#{member.discriminator}`"
                 )
                 return
             else:
+                updated_at = datetime.utcnow()
                 await self.db.find_one_and_update(
                     {"name": name},
-                    {"$set": {"author": ctx.author.id, "updatedAt": datetime.utcnow()}},
+                    {"$set": {"author": ctx.author.id, "updatedAt": updated_at}},
                 )
+                tag.update(author=ctx.author.id, updatedAt=updated_at)
 
                 await ctx.send(
                     f":white_check_mark: | Tag `{name}` is now owned by `{ctx.author.name}#{ctx.author.discriminator}`"
@@ -179,13 +303,18 @@ class TagsPlugin(commands.Cog):
         """
         tag = await self.find_db(name=name)
         if tag is None:
-            await ctx.send(f":x: | Tag {name} not found.")
+            suggestions = self.names.search(name)
+            if suggestions:
+                await ctx.send(
+                    f":x: | Tag {name} not found. Did you mean "
+                    + ", ".join(f"`{s}`" for s in suggestions)
+                    + "?"
+                )
+            else:
+                await ctx.send(f":x: | Tag {name} not found.")
             return
         else:
-            await ctx.send(tag["content"])
-            await self.db.find_one_and_update(
-                {"name": name}, {"$set": {"uses": tag["uses"] + 1}}
-            )
+            await self.send_tag(ctx.message, tag)
             return
 
     @commands.Cog.listener()
@@ -196,23 +325,33 @@ class TagsPlugin(commands.Cog):
         content = msg.content.replace(self.bot.prefix, "")
         names = content.split(" ")
 
-        tag = await self.db.find_one({"name": names[0]})
-        thing = json.loads(tag["content"])
-        embed = discord.Embed.from_dict(thing['embed'])
+        tag = await self.find_db(name=names[0])
         if tag is None:
             return
         else:
-            
-            
-            
-            await msg.channel.send(embed=embed)
-            await self.db.find_one_and_update(
-                {"name": names[0]}, {"$set": {"uses": tag["uses"] + 1}}
-            )
+            await self.send_tag(msg, tag)
             return
 
+    async def send_tag(self, msg: discord.Message, tag: Dict[str, Any]):
+        template = self.templates.get(tag["name"])
+        if template is None:
+            template = self.templates[tag["name"]] = TagTemplate(tag["content"])
+        await msg.channel.send(
+            **template.render(member=msg.author, guild=msg.guild, bot=self.bot.user)
+        )
+        self._record_use(tag)
+
     async def find_db(self, name: str):
-        return await self.db.find_one({"name": name})
+        # served from memory, unknown names never hit the database
+        await self._loaded.wait()
+        if self._cached:
+            return self.tags.get(name)
+
+        tag = await self.db.find_one({"name": name})
+        if tag is None:
+            return None
+        # later lookups share the document, so uses and edits apply to the same copy
+        return self.tags.setdefault(name, tag)
 
     #def format_message(self, tag: str, message: discord.Message) -> Dict[str, Union[Any]]:
     #    updated_tag: Dict[str, Union[Any]]